@@ -0,0 +1,286 @@
+import asyncio
+import random
+import time
+from contextlib import aclosing
+from urllib.parse import urlsplit
+
+import tracker
+import udp_tracker
+
+# Defaults
+ANNOUNCE_TIMEOUT = 15.0         # HTTP only, UDP requests time out per BEP 15
+DEFAULT_INTERVAL = 1800.0       # used if the tracker sends no interval
+MIN_RETRY_INTERVAL = 60.0       # first retry after a failed announce, doubled per failure
+SMALL_SWARM = 30                # below this many peers ask for more and announce at min interval
+SMALL_SWARM_NUM_WANT = 200
+NUM_WANT = 50
+
+HTTP_EVENTS = {
+    udp_tracker.EVENT_NONE: None,
+    udp_tracker.EVENT_COMPLETED: 'completed',
+    udp_tracker.EVENT_STARTED: 'started',
+    udp_tracker.EVENT_STOPPED: 'stopped',
+}
+
+
+def announce_tiers(torrent):
+    """
+    Tracker tiers of a torrent (BEP 12), shuffled within each tier.
+
+    Parameters:
+        torrent (torrent_file.Torrent): metadata
+
+    Returns:
+        list: [[url]] in tier order
+    """
+    tiers = [list(tier) for tier in torrent.announce_list if tier]
+    if not tiers and torrent.announce:
+        tiers = [[torrent.announce]]
+    for tier in tiers:
+        random.shuffle(tier)
+    return tiers
+
+
+class Announcer:
+    """
+    Announces a torrent to all its trackers at once, over UDP and HTTP.
+
+    Every tracker of every announce-list tier is contacted in parallel and
+    the peer lists are merged as the responses come in, so the first usable
+    peers are there as soon as the fastest tracker answered. Trackers that
+    answer are moved to the front of their tier (BEP 12).
+
+    Parameters:
+        torrent (torrent_file.Torrent): metadata
+        peer_id (bytes): 20-byte Peer-ID
+        port (int): port we listen on
+        udp_client (udp_tracker.UdpTrackerClient): shared UDP client, a private one is created if None
+        http_client (tracker.HttpTrackerClient): shared HTTP client, a private one is created if None
+    """
+
+    def __init__(self, torrent, peer_id, port=udp_tracker.DEFAULT_PORT, udp_client=None, http_client=None):
+        self.udp_client = udp_client if udp_client is not None else udp_tracker.UdpTrackerClient()
+        self.http_client = http_client if http_client is not None else tracker.HttpTrackerClient()
+        self.info_hash = torrent.info_hash
+        self.peer_id = peer_id
+        self.port = port
+        self.tiers = announce_tiers(torrent)
+        self.peers = {}         # (ip, port) -> tracker url, insertion ordered
+        self.results = {}       # url -> last response dict or exception
+
+    def trackers(self):
+        return [url for tier in self.tiers for url in tier]
+
+    def promote(self, url):
+        """Moves a tracker that answered to the front of its tier (BEP 12)"""
+        for tier in self.tiers:
+            if url in tier:
+                tier.remove(url)
+                tier.insert(0, url)
+                return
+
+    async def announce_udp(self, url, uploaded, downloaded, left, event, num_want, max_retries=None):
+        parts = urlsplit(url)
+        return await self.udp_client.announce(parts.hostname, parts.port, self.info_hash, self.peer_id,
+                                              downloaded, left, uploaded, event, self.port, num_want, max_retries)
+
+    async def announce_http(self, url, uploaded, downloaded, left, event, num_want):
+        numwant = None if num_want == udp_tracker.DEFAULT_NUM_WANT else num_want
+        return await asyncio.to_thread(self.http_client.announce, url, self.info_hash, self.peer_id, self.port,
+                                       uploaded, downloaded, left, HTTP_EVENTS[event], numwant)
+
+    async def announce_one(self, url, uploaded, downloaded, left, event,
+                           num_want=udp_tracker.DEFAULT_NUM_WANT, max_retries=None):
+        """
+        Parameters:
+            event (int): udp_tracker.EVENT_*, also used for HTTP trackers
+            num_want (int): number of peers wanted, -1 = tracker default
+            max_retries (int): UDP retransmissions, None = the full BEP 15 schedule
+
+        Returns:
+            tuple: (url, response dict or exception)
+        """
+        try:
+            if url.startswith('udp://'):
+                # The UDP client retransmits itself (BEP 15), bounded by max_retries
+                result = await self.announce_udp(url, uploaded, downloaded, left, event, num_want, max_retries)
+            elif url.startswith(('http://', 'https://')):
+                result = await asyncio.wait_for(
+                    self.announce_http(url, uploaded, downloaded, left, event, num_want), ANNOUNCE_TIMEOUT)
+            else:
+                result = ValueError(f"Unsupported tracker protocol: {url}")
+        except Exception as e:
+            result = e
+        return url, result
+
+    def merge(self, url, result):
+        """
+        Returns:
+            list: peers of this response that were not known yet
+        """
+        self.results[url] = result
+        if isinstance(result, Exception):
+            print(f"Tracker {url} failed: {result!r}")
+            return []
+        self.promote(url)
+        new_peers = [peer for peer in result['peers'] if peer not in self.peers]
+        for peer in new_peers:
+            self.peers[peer] = url
+        print(f"Tracker {url}: {len(result['peers'])} peers, {len(new_peers)} new")
+        return new_peers
+
+    async def announce_iter(self, uploaded=0, downloaded=0, left=0, event=udp_tracker.EVENT_STARTED,
+                            max_retries=None):
+        """
+        Announces to all trackers in parallel and yields the new peers of
+        every response as soon as it arrives.
+        """
+        tasks = [asyncio.create_task(self.announce_one(url, uploaded, downloaded, left, event,
+                                                       max_retries=max_retries))
+                 for url in self.trackers()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                url, result = await next_done
+                new_peers = self.merge(url, result)
+                if new_peers:
+                    yield new_peers
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def announce(self, uploaded=0, downloaded=0, left=0, event=udp_tracker.EVENT_STARTED,
+                       min_peers=1, wait_all=False, max_retries=udp_tracker.QUICK_MAX_RETRIES):
+        """
+        Announces to all trackers in parallel.
+
+        Parameters:
+            min_peers (int): return as soon as this many peers are known
+            wait_all (bool): wait for every tracker instead
+            max_retries (int): UDP retransmissions, the caller waits for the answer
+
+        Returns:
+            list: deduplicated [(ip, port)]
+        """
+        async with aclosing(self.announce_iter(uploaded, downloaded, left, event, max_retries)) as batches:
+            async for _ in batches:
+                if not wait_all and len(self.peers) >= min_peers:
+                    break
+        if not self.peers:
+            raise Exception("No working tracker found!")
+        return list(self.peers)
+
+
+class AnnounceScheduler:
+    """
+    Periodic announces of one torrent to all of its trackers.
+
+    Every tracker gets its own schedule: the first announce sends `started`,
+    later ones follow the tracker's `interval` (or `min interval` while the
+    swarm is small), failures are retried with exponential backoff. After
+    completed() every started tracker gets `completed` right away, and stop()
+    sends `stopped` before run() returns. While fewer than SMALL_SWARM peers
+    are known, announces ask for SMALL_SWARM_NUM_WANT peers.
+
+    Parameters:
+        announcer (Announcer): announcer of the torrent, its clients are reused
+        progress (callable): progress() -> (uploaded, downloaded, left, num_peers)
+        on_peers (callable): on_peers(peers), called with the deduplicated peer list of
+            every response, known peers included, so the swarm can dial them again
+    """
+
+    def __init__(self, announcer, progress, on_peers=None):
+        self.announcer = announcer
+        self.progress = progress
+        self.on_peers = on_peers
+        self.next_announce = {url: 0.0 for url in announcer.trackers()}    # url -> monotonic time
+        self.failures = {}      # url -> consecutive failures
+        self.started = set()    # trackers that accepted `started`
+        self.events = {}        # url -> pending event
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+
+    def completed(self):
+        """Download finished: send `completed` to every started tracker now"""
+        for url in self.started:
+            self.events[url] = udp_tracker.EVENT_COMPLETED
+            self.next_announce[url] = 0.0
+        self.wakeup.set()
+
+    def stop(self):
+        """Sends `stopped` to the started trackers and ends run()"""
+        self.stopping = True
+        self.wakeup.set()
+
+    def reschedule(self, url, result, small_swarm):
+        now = time.monotonic()
+        if isinstance(result, Exception):
+            failures = self.failures.get(url, 0) + 1
+            self.failures[url] = failures
+            self.next_announce[url] = now + min(MIN_RETRY_INTERVAL * 2 ** (failures - 1), DEFAULT_INTERVAL)
+            return
+        self.failures.pop(url, None)
+        interval = result.get('interval') or DEFAULT_INTERVAL
+        min_interval = result.get('min interval') or 0
+        if small_swarm and min_interval:
+            interval = min_interval
+        self.next_announce[url] = now if url in self.events else now + max(interval, min_interval)
+
+    async def announce(self, url, event):
+        uploaded, downloaded, left, num_peers = self.progress()
+        small_swarm = num_peers < SMALL_SWARM
+        num_want = SMALL_SWARM_NUM_WANT if small_swarm else NUM_WANT
+        max_retries = None
+        if event == udp_tracker.EVENT_STOPPED:
+            # The torrent is going away, a dead tracker must not hold up its removal
+            num_want = 0
+            max_retries = udp_tracker.QUICK_MAX_RETRIES
+        _, result = await self.announcer.announce_one(url, uploaded, downloaded, left, event, num_want, max_retries)
+        return url, event, result, small_swarm
+
+    def next_event(self, url):
+        if url not in self.started:
+            return udp_tracker.EVENT_STARTED
+        return self.events.pop(url, udp_tracker.EVENT_NONE)
+
+    def finished(self, url, event, result, small_swarm):
+        if event == udp_tracker.EVENT_STARTED and not isinstance(result, Exception):
+            self.started.add(url)
+        elif event == udp_tracker.EVENT_COMPLETED and isinstance(result, Exception):
+            self.events[url] = event
+        self.announcer.merge(url, result)
+        if not isinstance(result, Exception) and result['peers'] and self.on_peers is not None:
+            self.on_peers(list(dict.fromkeys(result['peers'])))
+        self.reschedule(url, result, small_swarm)
+
+    async def run(self):
+        """
+        Every announce runs as its own task and is handled when it finishes,
+        so a tracker that takes long to answer only delays its own schedule.
+        """
+        running = {}        # url -> announce task
+        try:
+            while not self.stopping:
+                self.wakeup.clear()
+                now = time.monotonic()
+                for url, when in self.next_announce.items():
+                    if when <= now and url not in running:
+                        running[url] = asyncio.create_task(self.announce(url, self.next_event(url)))
+                idle = [when for url, when in self.next_announce.items() if url not in running]
+                timeout = max(min(idle, default=now + DEFAULT_INTERVAL) - now, 0)
+                wakeup = asyncio.create_task(self.wakeup.wait())
+                try:
+                    await asyncio.wait([wakeup, *running.values()], timeout=timeout,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    wakeup.cancel()
+                for url, task in list(running.items()):
+                    if task.done():
+                        del running[url]
+                        self.finished(*task.result())
+        finally:
+            for task in running.values():
+                task.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+        if self.started:
+            await asyncio.gather(*(self.announce(url, udp_tracker.EVENT_STOPPED) for url in self.started))
+            self.started.clear()
@@ -0,0 +1,302 @@
+import asyncio
+import time
+from collections import deque
+
+# Directions
+DOWNLOAD = 0
+UPLOAD = 1
+
+# Defaults
+DEFAULT_TICK = 0.05             # seconds between two quota rounds
+BURST_SECONDS = 0.5             # bucket size in seconds of its rate
+MIN_BURST = 32 * 1024           # a bucket holds at least two blocks
+MIN_QUANTUM = 1024              # smallest grant, avoids reads of a few bytes
+
+
+class TokenBucket:
+    """
+    Token bucket for one direction of one level. rate None = unlimited.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate=None, now=None):
+        self.updated = time.monotonic() if now is None else now
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = rate or None
+        self.burst = max(self.rate * BURST_SECONDS, MIN_BURST) if self.rate else None
+        self.tokens = self.burst
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """
+        Returns:
+            float: tokens in the bucket, None if unlimited
+        """
+        return None if self.rate is None else self.tokens
+
+    def consume(self, amount):
+        if self.rate is not None:
+            self.tokens -= amount
+
+
+class Waiter:
+    __slots__ = ('limiter', 'amount', 'future', 'since')
+
+    def __init__(self, limiter, amount, future, since):
+        self.limiter = limiter
+        self.amount = amount
+        self.future = future
+        self.since = since
+
+
+class PeerLimiter:
+    """
+    Bandwidth quota of one peer connection, see BandwidthScheduler.peer().
+    """
+
+    def __init__(self, scheduler, torrent_key, download_rate=None, upload_rate=None):
+        self.scheduler = scheduler
+        self.torrent_key = torrent_key
+        self.buckets = (TokenBucket(download_rate), TokenBucket(upload_rate))
+        self.used = [0, 0]      # bytes granted in the current tick
+        self.wait_seconds = [0.0, 0.0]
+
+    def chain(self, direction):
+        """Buckets a transfer has to pass: peer, torrent (unless removed meanwhile), global"""
+        torrent = self.scheduler.torrents.get(self.torrent_key)
+        if torrent is None:
+            return self.buckets[direction], self.scheduler.buckets[direction]
+        return self.buckets[direction], torrent[direction], self.scheduler.buckets[direction]
+
+    async def quota(self, direction, amount):
+        """
+        Returns:
+            int: bytes granted, MIN_QUANTUM (or amount if smaller) <= granted <= amount,
+                 already taken from all levels
+        """
+        return await self.scheduler.request(self, direction, amount)
+
+    async def acquire(self, direction, amount):
+        """Waits until all `amount` bytes are granted, in fair shares per tick"""
+        remaining = amount
+        while remaining > 0:
+            remaining -= await self.quota(direction, remaining)
+        return amount
+
+    async def download(self, amount):
+        """Pays for `amount` bytes that were just read; the caller processes them afterwards"""
+        return await self.acquire(DOWNLOAD, amount)
+
+    async def upload(self, amount):
+        """Waits until `amount` bytes may be written"""
+        return await self.acquire(UPLOAD, amount)
+
+    def close(self, error=None):
+        """
+        Parameters:
+            error (Exception): raised in transfers still waiting for tokens, None = cancel them
+        """
+        self.scheduler.remove_peer(self, error)
+
+
+class BandwidthScheduler:
+    """
+    Hard upload and download caps at three levels: global, per torrent and per peer.
+
+    Every level is a token bucket. A transfer takes tokens from the peer's,
+    the torrent's and the global bucket at once. If any of them is short, the
+    request waits for the next tick, where the available tokens are shared
+    fairly: every waiting peer gets an equal share (at most what it asked
+    for), leftovers go to the peers that want more. Reads are paid after the
+    fact, before their messages are processed, so TCP flow control slows the
+    peer down while the request pipeline keeps its window. Time spent
+    waiting for tokens is accounted per direction.
+
+    Parameters:
+        download_rate (float): global download cap in bytes/s, None = unlimited
+        upload_rate (float): global upload cap in bytes/s, None = unlimited
+        tick (float): seconds between quota rounds
+        peer_download_rate (float): default download cap of every peer, None = unlimited
+        peer_upload_rate (float): default upload cap of every peer, None = unlimited
+    """
+
+    def __init__(self, download_rate=None, upload_rate=None, tick=DEFAULT_TICK,
+                 peer_download_rate=None, peer_upload_rate=None):
+        self.tick = tick
+        self.peer_rates = (peer_download_rate, peer_upload_rate)
+        self.buckets = (TokenBucket(download_rate), TokenBucket(upload_rate))
+        self.torrents = {}              # torrent key -> (download bucket, upload bucket)
+        self.peers = set()
+        self.waiting = (deque(), deque())
+        self.active = (set(), set())    # peers that got tokens during the current tick
+        self.fair_share = [None, None]  # bytes a peer may take per tick without waiting
+        self.task = None
+        # Statistics
+        self.wait_seconds = [0.0, 0.0]
+        self.waits = [0, 0]
+        self.granted = [0, 0]
+
+    def set_global_rate(self, download_rate=None, upload_rate=None):
+        self.buckets[DOWNLOAD].set_rate(download_rate)
+        self.buckets[UPLOAD].set_rate(upload_rate)
+
+    def add_torrent(self, key, download_rate=None, upload_rate=None):
+        self.torrents[key] = (TokenBucket(download_rate), TokenBucket(upload_rate))
+
+    def remove_torrent(self, key):
+        """Drops the torrent's buckets, its peers that still wait for tokens get ConnectionAbortedError"""
+        for limiter in [limiter for limiter in self.peers if limiter.torrent_key == key]:
+            limiter.close(ConnectionAbortedError("Torrent removed"))
+        self.torrents.pop(key, None)
+
+    def set_peer_rate(self, download_rate=None, upload_rate=None):
+        """Default caps of peers that connect from now on"""
+        self.peer_rates = (download_rate, upload_rate)
+
+    def peer(self, torrent_key, download_rate=None, upload_rate=None):
+        """
+        Parameters:
+            download_rate (float): cap of this peer, None = the default peer_download_rate
+            upload_rate (float): cap of this peer, None = the default peer_upload_rate
+
+        Returns:
+            PeerLimiter: quota of a new peer connection of that torrent
+        """
+        if torrent_key not in self.torrents:
+            self.add_torrent(torrent_key)
+        if download_rate is None:
+            download_rate = self.peer_rates[DOWNLOAD]
+        if upload_rate is None:
+            upload_rate = self.peer_rates[UPLOAD]
+        limiter = PeerLimiter(self, torrent_key, download_rate, upload_rate)
+        self.peers.add(limiter)
+        return limiter
+
+    def remove_peer(self, limiter, error=None):
+        self.peers.discard(limiter)
+        for active in self.active:
+            active.discard(limiter)
+        for queue in self.waiting:
+            for waiter in [waiter for waiter in queue if waiter.limiter is limiter]:
+                queue.remove(waiter)
+                if waiter.future.done():
+                    continue
+                if error is None:
+                    waiter.future.cancel()
+                else:
+                    waiter.future.set_exception(error)
+
+    def grantable(self, limiter, direction, amount):
+        for bucket in limiter.chain(direction):
+            available = bucket.available()
+            if available is not None:
+                amount = min(amount, int(available))
+        return amount
+
+    def grant(self, limiter, direction, amount):
+        for bucket in limiter.chain(direction):
+            bucket.consume(amount)
+        self.granted[direction] += amount
+        limiter.used[direction] += amount
+        self.active[direction].add(limiter)
+
+    async def request(self, limiter, direction, amount):
+        now = time.monotonic()
+        queue = self.waiting[direction]
+        if self.task is None or self.task.done():
+            self.new_round(len(self.peers))
+            self.task = asyncio.create_task(self.run())
+        share = self.fair_share[direction]
+        if share is not None or not queue:
+            # Fast path: every level has the tokens and the peer is within its share of
+            # this tick, others that used up theirs wait for the next one
+            for bucket in limiter.chain(direction):
+                bucket.refill(now)
+            granted = self.grantable(limiter, direction, amount)
+            if share is not None:
+                granted = min(granted, share - limiter.used[direction])
+            if granted >= min(amount, MIN_QUANTUM):
+                self.grant(limiter, direction, granted)
+                return granted
+        future = asyncio.get_running_loop().create_future()
+        queue.append(Waiter(limiter, amount, future, now))
+        return await future
+
+    def new_round(self, num_active):
+        """
+        Splits the tokens in the global buckets among the peers that were
+        active, each peer may take that much without waiting until the next tick.
+        """
+        for direction, bucket in enumerate(self.buckets):
+            available = bucket.available()
+            if available is None:
+                self.fair_share[direction] = None
+            else:
+                self.fair_share[direction] = max(MIN_QUANTUM, int(max(0.0, available) / max(1, num_active)))
+        for limiter in self.peers:
+            limiter.used = [0, 0]
+
+    def distribute(self, direction, now):
+        """One quota round: equal shares for all waiting peers, then the leftovers"""
+        queue = self.waiting[direction]
+        for _ in range(2):
+            if not queue:
+                return
+            available = self.buckets[direction].available()
+            share = None if available is None else max(MIN_QUANTUM, int(available) // len(queue))
+            for _ in range(len(queue)):
+                waiter = queue.popleft()
+                if waiter.future.done():
+                    # The waiting connection was cancelled
+                    continue
+                wanted = waiter.amount if share is None else min(waiter.amount, share)
+                granted = self.grantable(waiter.limiter, direction, wanted)
+                if granted < min(wanted, MIN_QUANTUM):
+                    queue.append(waiter)
+                    continue
+                self.grant(waiter.limiter, direction, granted)
+                waited = now - waiter.since
+                self.wait_seconds[direction] += waited
+                waiter.limiter.wait_seconds[direction] += waited
+                self.waits[direction] += 1
+                waiter.future.set_result(granted)
+
+    async def run(self):
+        """Quota rounds, as long as peers transfer or wait"""
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            for bucket in self.buckets:
+                bucket.refill(now)
+            for buckets in self.torrents.values():
+                for bucket in buckets:
+                    bucket.refill(now)
+            for limiter in self.peers:
+                for bucket in limiter.buckets:
+                    bucket.refill(now)
+            for direction in (DOWNLOAD, UPLOAD):
+                self.distribute(direction, now)
+            num_active = max(len(active) + len(queue) for active, queue in zip(self.active, self.waiting))
+            if num_active == 0:
+                return
+            for active in self.active:
+                active.clear()
+            self.new_round(num_active)
+
+    def stats(self):
+        """
+        Returns:
+            dictionary: per direction the bytes granted, number of waits and seconds spent waiting
+        """
+        return {
+            name: {'bytes': self.granted[direction], 'waits': self.waits[direction],
+                   'wait_seconds': self.wait_seconds[direction]}
+            for name, direction in (('download', DOWNLOAD), ('upload', UPLOAD))
+        }
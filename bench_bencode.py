@@ -0,0 +1,66 @@
+"""
+Benchmark: decode_dict (str, rekursiv) gegen decode (bytes, iterativ).
+
+    python bench_bencode.py [datei.torrent]
+
+Ohne Argument werden zwei synthetische Torrents mit 200.000 Pieces (4 MB
+pieces-String) erzeugt, einer mit 10.000 Dateien und einer mit 10.
+"""
+import hashlib
+import os
+import sys
+import time
+
+import bencode
+
+
+def make_torrent(num_files=10000, num_pieces=200000):
+    info = {
+        'name': 'bench',
+        'piece length': 262144,
+        'pieces': os.urandom(20 * num_pieces),
+        'files': [{'length': 1000 + i, 'path': ['dir', f'file{i}.bin']} for i in range(num_files)],
+    }
+    return bencode.bencode_encode({'announce': 'udp://tracker.example:1337/announce', 'info': info})
+
+
+def best_of(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            run(f.read())
+    else:
+        run(make_torrent())
+        run(make_torrent(num_files=10))
+
+
+def run(data):
+    print(f"Torrent: {len(data)} bytes")
+
+    def old():
+        torrent, _ = bencode.decode_dict(data.decode('latin-1'), 0)
+        return hashlib.sha1(bencode.bencode_encode(torrent['info'])).digest()
+
+    def new():
+        _, info = bencode.decode_torrent(data)
+        return hashlib.sha1(info).digest()
+
+    old_time, old_hash = best_of(old)
+    new_time, new_hash = best_of(new)
+    assert old_hash == new_hash, "Info hashes differ"
+    print(f"decode_dict + re-encode: {old_time * 1000:8.1f} ms")
+    print(f"decode_torrent:          {new_time * 1000:8.1f} ms  ({old_time / new_time:.1f}x)")
+    print(f"Info hash: {new_hash.hex()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark: Peer-Liste Eintrag für Eintrag (struct.unpack + inet_ntoa) gegen compact_peers.decode_peers.
+
+    python bench_peers.py
+
+Erzeugt kompakte Peer-Listen mit 1.000 bis 50.000 Einträgen, davon 10 % doppelt,
+sowie eine IPv6-Liste ("peers6").
+"""
+import os
+import random
+import socket
+import struct
+import time
+
+from compact_peers import PEER_SIZE, PEER6_SIZE, decode_peers
+
+
+def make_peers(num_peers, entry_size=PEER_SIZE, duplicates=0.1):
+    unique = [os.urandom(entry_size) for _ in range(num_peers - int(num_peers * duplicates))]
+    entries = unique + random.choices(unique, k=num_peers - len(unique))
+    random.shuffle(entries)
+    return b''.join(entries)
+
+
+def old_decode(data):
+    """Bisherige Schleife aus udp_tracker.parse_announce_response"""
+    peers = []
+    for i in range(len(data) // PEER_SIZE):
+        start = i * PEER_SIZE
+        ip_bytes, port = struct.unpack(">4sH", data[start:start + PEER_SIZE])
+        peers.append((socket.inet_ntoa(ip_bytes), port))
+    return peers
+
+
+def best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    for num_peers in (1000, 5000, 50000):
+        data = make_peers(num_peers)
+        old_time, old_peers = best_of(lambda: old_decode(data))
+        new_time, new_peers = best_of(lambda: decode_peers(data))
+        assert new_peers == list(dict.fromkeys(old_peers)), "Peer lists differ"
+        print(f"{num_peers:6} peers: loop {old_time * 1000:7.2f} ms, "
+              f"decode_peers {new_time * 1000:7.2f} ms ({old_time / new_time:.1f}x), "
+              f"{len(new_peers)} unique")
+
+    data = make_peers(5000, PEER6_SIZE)
+    new_time, new_peers = best_of(lambda: decode_peers(data, ipv6=True))
+    print(f"  5000 IPv6 peers: decode_peers {new_time * 1000:7.2f} ms, {len(new_peers)} unique")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import re
+from collections.abc import Iterator
+
 def decode_string(input, start = 0):
     pos = start
     char = input[start]
@@ -94,31 +97,205 @@ def decode_dict(input, start = 0):
     return res, res_len
 
 
+_INT = re.compile(rb'i(-?\d+)e')
+_STRING_LENGTH = re.compile(rb'(\d+):')
+
+
+class _DictFrame:
+    """Dictionary under construction on the decoder stack"""
+    __slots__ = ('value', 'key')
+
+    def __init__(self):
+        self.value = {}
+        self.key = None
+
+
+def decode(data, start=0, spans=None, view_threshold=None):
+    """
+    Decodes bencoded bytes (bytes, bytearray, memoryview or mmap).
+
+    Works on the raw bytes without recursion: integers and string lengths are
+    found with regular expressions (C speed), containers live on an explicit
+    stack. Strings are returned as bytes, dictionary keys as latin-1 str so
+    lookups like torrent['info'] keep working.
+
+    Parameters:
+        data: bencoded bytes
+        start (int): offset of the value
+        spans (dict): if given, receives {key: (start, end)} of the raw value
+                      of every key of the top-level dictionary
+        view_threshold (int): strings of at least this length are returned as
+                      memoryview slices of data instead of bytes copies
+
+    Returns:
+        tuple: (value, end_offset)
+    """
+    view = memoryview(data) if view_threshold is not None else None
+    match_int = _INT.match
+    match_length = _STRING_LENGTH.match
+    stack = []          # lists and _DictFrames
+    value_start = None
+    pos = start
+    while True:
+        try:
+            char = data[pos]
+        except IndexError:
+            raise ValueError(f"Unexpected end of data at offset {pos}") from None
+        if char == 0x69:        # i
+            match = match_int(data, pos)
+            if match is None:
+                raise ValueError(f"Invalid integer at offset {pos}")
+            value = int(match.group(1))
+            pos = match.end()
+        elif 0x30 <= char <= 0x39:
+            match = match_length(data, pos)
+            if match is None:
+                raise ValueError(f"Invalid string length at offset {pos}")
+            string_start = match.end()
+            pos = string_start + int(match.group(1))
+            if pos > len(data):
+                raise ValueError(f"String at offset {string_start} runs past the end of data")
+            if view is not None and pos - string_start >= view_threshold:
+                value = view[string_start:pos]
+            else:
+                value = bytes(data[string_start:pos])
+        elif char == 0x6c:      # l
+            stack.append([])
+            pos += 1
+            continue
+        elif char == 0x64:      # d
+            stack.append(_DictFrame())
+            pos += 1
+            continue
+        elif char == 0x65 and stack:    # e
+            frame = stack.pop()
+            if type(frame) is list:
+                value = frame
+            else:
+                if frame.key is not None:
+                    raise ValueError(f"Dictionary key {frame.key!r} without value")
+                value = frame.value
+            pos += 1
+        else:
+            raise ValueError(f"Unexpected byte {bytes([char])!r} at offset {pos}")
+
+        if not stack:
+            return value, pos
+        frame = stack[-1]
+        if type(frame) is list:
+            frame.append(value)
+        elif frame.key is None:
+            if type(value) is memoryview:
+                value = bytes(value)
+            elif type(value) is not bytes:
+                raise ValueError(f"Dictionary key must be a string, got {type(value).__name__}")
+            frame.key = value.decode('latin-1')
+            if spans is not None and len(stack) == 1:
+                # The value of a top-level key starts right after the key
+                value_start = pos
+        else:
+            frame.value[frame.key] = value
+            if spans is not None and len(stack) == 1:
+                spans[frame.key] = (value_start, pos)
+            frame.key = None
+
+
+def decode_torrent(data, view_threshold=None):
+    """
+    Decodes a .torrent file.
+
+    Parameters:
+        view_threshold (int): see decode()
+
+    Returns:
+        tuple: (torrent: dict, info: the raw bencoded bytes of the info dictionary)
+    """
+    spans = {}
+    torrent, _ = decode(data, 0, spans, view_threshold)
+    if not isinstance(torrent, dict) or 'info' not in spans:
+        raise ValueError("Not a torrent file: no info dictionary")
+    info_start, info_end = spans['info']
+    return torrent, data[info_start:info_end]
+
+
+SINK_CHUNK = 64 * 1024
+
+
+def _dict_items(data):
+    keys = list(data.keys())
+    keys.sort()
+    for key in keys:
+        yield key
+        yield data[key]
+
+
+def encode(data, sink=None):
+    """
+    Encodes data in linear time.
+
+    All fragments are appended to one bytearray; nested lists and dicts are
+    handled with an explicit stack of iterators instead of recursion, so no
+    temporary byte strings are built per nested value. Lists may also be
+    given as iterators/generators to stream very large structures.
+
+    Parameters:
+        data: int, str, bytes, list/tuple/iterator or dict (keys are sorted)
+        sink: file-like object with write(); if given, the output is written
+              in chunks of about SINK_CHUNK bytes and nothing is returned
+
+    Returns:
+        bytearray: encoded data, or None if a sink was given
+    """
+    out = bytearray()
+    stack = [iter((data,))]
+    while stack:
+        for value in stack[-1]:
+            break
+        else:
+            stack.pop()
+            if stack:
+                out += b'e'
+            continue
+
+        if isinstance(value, int):
+            out += b'i%de' % value
+        elif isinstance(value, str):
+            out += b'%d:' % len(value)
+            out += value.encode('latin-1')
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            out += b'%d:' % len(value)
+            if sink is not None and len(value) >= SINK_CHUNK:
+                # Large strings go to the sink without being copied into out
+                sink.write(out)
+                out.clear()
+                sink.write(value)
+            else:
+                out += value
+        elif isinstance(value, dict):
+            out += b'd'
+            stack.append(_dict_items(value))
+        elif isinstance(value, (list, tuple)):
+            out += b'l'
+            stack.append(iter(value))
+        elif isinstance(value, Iterator):
+            out += b'l'
+            stack.append(value)
+        else:
+            raise TypeError(f"Can't encode type {type(value)}")
+
+        if sink is not None and len(out) >= SINK_CHUNK:
+            sink.write(out)
+            out.clear()
+
+    if sink is None:
+        return out
+    if out:
+        sink.write(out)
+    return None
+
+
 def bencode_encode(data):
-    if isinstance(data, int):
-        return f"i{data}e".encode('latin-1')
-    elif isinstance(data, str):
-        return f"{len(data)}:{data}".encode('latin-1')
-    elif isinstance(data, bytes):
-        return f"{len(data)}:".encode('latin-1') + data
-    elif isinstance(data, list):
-        result = b'l'
-        for element in data:
-            result += bencode_encode(element)
-        result += b'e'
-        return result
-    elif isinstance(data, dict):
-        keys = list(data.keys())
-        keys.sort()
-        result = b'd'
-        for key in keys:
-            value = data[key]
-            result += bencode_encode(key)
-            result += bencode_encode(value)
-        result += b'e'
-        return result
-    else:
-        raise TypeError(f"Can't encode type {type(data)}")
+    return bytes(encode(data))
 
 
 
@@ -233,8 +410,51 @@ def test_dict():
     assert value == {"list": [1, 2]}
     print("Dict Test 3")
 
+def test_decode():
+    data = b"d4:infod6:lengthi5e4:name3:abce3:numi-3e4:listl2:xyi0eee"
+    value, end = decode(data)
+    expected = {"info": {"length": 5, "name": b"abc"}, "num": -3, "list": [b"xy", 0]}
+    assert value == expected and end == len(data), f"Got ({value}, {end})"
+    print("Decode Test 1: Verschachteltes Dict")
 
+    # Round-Trip: encode(decode(x)) == x, Keys sortiert
+    data = b"d1:ai1e1:bl1:xd1:yi-7eee1:c0:e"
+    value, _ = decode(data)
+    assert bencode_encode(value) == data, f"Got {bencode_encode(value)!r}"
+    value = {"z": [1, b"two", {"k": b""}], "a": 0, "m": {"n": -1}}
+    assert decode(bencode_encode(value))[0] == value
+    print("Decode Test 2: Round-Trip")
 
+    # Der Info-Hash wird über die rohen Bytes des info-Dicts berechnet
+    data = b"d8:announce3:url4:infod6:lengthi5e4:name3:abcee"
+    spans = {}
+    decode(data, 0, spans)
+    assert data[spans["info"][0]:spans["info"][1]] == b"d6:lengthi5e4:name3:abce", f"Got {spans}"
+    torrent, info = decode_torrent(data)
+    assert info == b"d6:lengthi5e4:name3:abce" and torrent["announce"] == b"url"
+    print("Decode Test 3: Info-Span")
 
+    value, _ = decode(b"l5:hello2:abe", view_threshold=4)
+    assert isinstance(value[0], memoryview) and bytes(value[0]) == b"hello" and value[1] == b"ab"
+    print("Decode Test 4: view_threshold")
 
+    for data, reason in ((b"5:abc", "String zu kurz"),
+                         (b"d3:key", "Dict abgeschnitten"),
+                         (b"d3:keye", "Key ohne Value"),
+                         (b"di1e3:abce", "Key kein String"),
+                         (b"i12", "Integer abgeschnitten"),
+                         (b"x", "Unbekanntes Byte"),
+                         (b"", "Leere Daten")):
+        try:
+            decode(data)
+        except ValueError:
+            continue
+        raise AssertionError(f"{reason}: {data!r} decoded without error")
+    print("Decode Test 5: Fehlerhafte Daten")
 
+    try:
+        decode_torrent(b"d8:announce3:urle")
+    except ValueError:
+        print("Decode Test 6: Torrent ohne info")
+    else:
+        raise AssertionError("Torrent without info decoded")
@@ -0,0 +1,82 @@
+import asyncio
+import random
+import time
+
+# Defaults
+DEFAULT_UPLOAD_SLOTS = 4            # unchoked peers, including the optimistic one
+RECHOKE_INTERVAL = 10.0
+OPTIMISTIC_INTERVAL = 30.0
+NEW_PEER_TIME = 60.0                # peers connected for less get a 3x chance to be picked optimistically
+NEW_PEER_WEIGHT = 3
+
+
+class Choker:
+    """
+    Tit-for-tat choking of the peers we upload to.
+
+    Every RECHOKE_INTERVAL the interested peers that reciprocate best are
+    unchoked (upload_slots - 1 of them), all others are choked. One more slot
+    goes to an optimistic unchoke that rotates every OPTIMISTIC_INTERVAL, so
+    new peers get a chance to show what they give back.
+
+    Connections need `peer_interested`, `am_choking`, `connected_at`,
+    choke() and unchoke().
+
+    Parameters:
+        rate (callable): rate(conn) -> bytes/s the peer is ranked by
+        upload_slots (int): number of unchoked peers
+    """
+
+    def __init__(self, rate, upload_slots=DEFAULT_UPLOAD_SLOTS):
+        self.rate = rate
+        self.upload_slots = upload_slots
+        self.connections = set()
+        self.optimistic = None
+        self.optimistic_since = None
+
+    def add(self, conn):
+        self.connections.add(conn)
+
+    def remove(self, conn):
+        self.connections.discard(conn)
+        if conn is self.optimistic:
+            self.optimistic = None
+
+    def peer_interested(self, conn):
+        """Free slots are handed out right away instead of at the next rechoke"""
+        unchoked = sum(1 for other in self.connections if not other.am_choking)
+        if conn.am_choking and unchoked < self.upload_slots:
+            conn.unchoke()
+
+    def pick_optimistic(self, candidates, now):
+        if not candidates:
+            return None
+        weights = [NEW_PEER_WEIGHT if now - conn.connected_at < NEW_PEER_TIME else 1 for conn in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def rechoke(self, now=None):
+        now = time.monotonic() if now is None else now
+        interested = [conn for conn in self.connections if conn.peer_interested]
+        interested.sort(key=self.rate, reverse=True)
+        regular = interested[:max(0, self.upload_slots - 1)]
+        unchoke = set(regular)
+
+        rotate = self.optimistic_since is None or now - self.optimistic_since >= OPTIMISTIC_INTERVAL
+        if (rotate or self.optimistic not in self.connections or self.optimistic in unchoke
+                or not self.optimistic.peer_interested):
+            candidates = [conn for conn in interested if conn not in unchoke]
+            self.optimistic = self.pick_optimistic(candidates, now)
+            self.optimistic_since = now
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for conn in list(self.connections):
+            if conn in unchoke:
+                conn.unchoke()
+            else:
+                conn.choke()
+
+    async def run(self):
+        while True:
+            self.rechoke()
+            await asyncio.sleep(RECHOKE_INTERVAL)
@@ -1,90 +1,205 @@
 import torrent_file
 import udp_tracker
 import peer_protocol
+import swarm
+import announcer
+import storage
+import seeder
+import bandwidth
+import asyncio
+from collections import deque
+from pipeline import BLOCK_SIZE, RequestWindow
+from piece_picker import Bitfield
+from verifier import IncrementalPiece
 
-def load_torrent(file):
-    torrent = torrent_file.parse_torrent_file(file)
-    info_hash = torrent_file.calculate_info_hash(torrent['info'])
-    return torrent, info_hash
+def load_torrent(file, use_mmap=False):
+    """
+    Returns:
+        tuple: (torrent_file.Torrent, info_hash: bytes)
+    """
+    torrent = torrent_file.Torrent.from_file(file, use_mmap)
+    return torrent, torrent.info_hash
 
 def get_peers_from_tracker(torrent, info_hash):
-    """Kontaktiert Tracker, gibt Peer-Liste zurück"""    
-    tracker, port = torrent_file.get_tracker_and_port(torrent)
-    packet, expected_transaction_id = udp_tracker.build_connect_request()
-    response, addr = udp_tracker.send_request(tracker, port, packet)
-    _, _, con_id = udp_tracker.parse_connect_response(response, expected_transaction_id)
+    """Kontaktiert alle Tracker gleichzeitig, gibt Peer-Liste zurück"""    
     peer_id = udp_tracker.generate_peer_id()
-    
-    downloaded = 0
-    size = torrent_file.get_total_size(torrent)
-    uploaded = 0
-    packet, trans_id = udp_tracker.build_announce_request(con_id, info_hash, peer_id, downloaded, size, uploaded)
-    response, addr = udp_tracker.send_request(tracker, port, packet)
-    result = udp_tracker.parse_announce_response(response, trans_id)
-    peers = result['peers']
+    tracker_announcer = announcer.Announcer(torrent, peer_id)
+    peers = asyncio.run(announce_once(tracker_announcer, torrent.total_size))
     print(f"Found {len(peers)} peers")
     return peers, peer_id
 
-def connect_to_peer(peers, info_hash, peer_id):
-    """Findet funktionierenden Peer, macht Handshake"""
+async def announce_once(tracker_announcer, left):
+    """Ein einzelnes Announce, danach werden Socket und HTTP-Verbindungen geschlossen"""
+    try:
+        return await tracker_announcer.announce(left=left)
+    finally:
+        tracker_announcer.udp_client.close()
+        tracker_announcer.http_client.close()
+
+def connect_to_peer(peers, info_hash, peer_id, num_pieces):
+    """
+    Findet funktionierenden Peer, macht Handshake
+
+    Returns:
+        tuple: (socket, piece_picker.Bitfield der Pieces des Peers)
+    """
     sock, peer_info = peer_protocol.find_working_peer(peers, info_hash, peer_id)
     message_id, payload = peer_protocol.receive_message(sock)
     print(f"Received: message_id={message_id}, payload_len={len(payload)}")
-    return sock
+    if message_id == peer_protocol.MSG_BITFIELD:
+        bitfield = Bitfield.from_payload(payload, num_pieces)
+    else:
+        bitfield = Bitfield(num_pieces)
+    print(f"Peer has {bitfield.count}/{num_pieces} pieces")
+    return sock, bitfield
 
-def download_piece(sock, piece_index, torrent):
+def download_blocks_pipelined(sock, piece, window):
+    """
+    Lädt alle Blöcke einer Piece mit mehreren Requests gleichzeitig.
 
+    Parameters:
+        sock: Socket-Verbindung
+        piece (verifier.IncrementalPiece): Ziel-Puffer, hasht während die Blöcke ankommen
+        window (pipeline.RequestWindow): Request-Fenster dieser Verbindung
+    """
+    pending = deque((begin, min(BLOCK_SIZE, piece.length - begin))
+                    for begin in range(0, piece.length, BLOCK_SIZE))
+    reader = peer_protocol.MessageReader(sock)
+    outgoing = peer_protocol.OutgoingQueue()
+    choked = False
+
+    while not piece.is_complete():
+        while not choked and pending and window.has_room():
+            begin, length = pending.popleft()
+            outgoing.request(piece.index, begin, length)
+            window.on_request(piece.index, begin, length)
+        outgoing.flush(sock)
+
+        message_id, payload = reader.receive()
+        if message_id == 7:
+            index, begin, block_data = peer_protocol.parse_piece(payload)
+            if index != piece.index or not window.on_block(index, begin, len(block_data)):
+                continue
+            piece.add_block(begin, block_data)
+        elif message_id == 0:
+            # Choke: der Peer verwirft alle offenen Requests
+            choked = True
+            for _, begin, length in window.cancel_all():
+                pending.appendleft((begin, length))
+        elif message_id == 1:
+            # Unchoke: Requests, die noch während des Chokes rausgingen, hat der Peer verworfen
+            choked = False
+            for _, begin, length in window.cancel_all():
+                pending.appendleft((begin, length))
+        # Alle anderen Messages (have, bitfield, keep-alive, ...) ändern nichts am Download
+
+    print(f"Window: {window.size} requests, rate: {window.rate() / 1024:.1f} KiB/s")
+
+def download_piece(sock, piece_index, torrent, window=None):
+    """
+    Lädt eine Piece. Choke/Unchoke werden in download_blocks_pipelined
+    behandelt: bei einem Choke wird auf das Unchoke gewartet und die
+    verworfenen Requests werden neu gesendet.
+
+    Parameters:
+        window (pipeline.RequestWindow): None = ein Request pro Round Trip
+    """
     peer_protocol.send_interested(sock)
     print("Sent: interested")
-    
-    message_id, payload = peer_protocol.receive_message(sock)
-    print(f"1. Received: message_id={message_id}")
-
-    piece_data = b''
-    piece_length = peer_protocol.get_piece_length(torrent, piece_index)
-    num_blocks = (piece_length + 16383) // 16384 
-
-    for block_num in range(num_blocks):
-        begin = block_num * 16384
-        peer_protocol.send_request(sock, piece_index, begin)
-        print(f"Send request for piece index {piece_index}")
-
-
-        for i in range(5):  # Falls ein Choke kommt 
-            message_id, payload = peer_protocol.receive_message(sock)
-            print(f"{i+2}. Received: message_id={message_id}, payload_len={len(payload)}")
-            if message_id == 7:
-                piece_index, begin, block_data = peer_protocol.parse_piece(payload)
-                piece_data += block_data
-                break
-
-    print(f"\nPiece Data Length: {len(piece_data)} bytes")
-    print(f"Expected: {torrent['info']['piece length']} bytes")
-    pieces_hashes = torrent['info']['pieces']
-    expected_hash = pieces_hashes[piece_index*20: piece_index*20+20]
-    if isinstance(expected_hash, str):
-        expected_hash = expected_hash.encode('latin-1')
-    if peer_protocol.validate_piece(piece_data, expected_hash):
+
+    piece_length = torrent.piece_size(piece_index)
+    expected_hash = torrent.piece_hash(piece_index)
+    piece = IncrementalPiece(piece_index, piece_length, expected_hash)
+    if window is None:
+        window = RequestWindow(size=1, min_size=1, max_size=1)
+    download_blocks_pipelined(sock, piece, window)
+
+    print(f"\nPiece Data Length: {piece.received} bytes")
+    print(f"Expected: {piece_length} bytes")
+    return verify_piece(piece)
+
+def verify_piece(piece):
+    """Der Hash wurde schon beim Empfang der Blöcke berechnet"""
+    if piece.is_valid():
         print("Piece ok!")
-        return piece_data
+        return piece.data
     else:
         raise Exception("Fehler: Hash of piece does not match the expected hash.")
         
-def download_file(sock, torrent, output_filename):
+def open_storage(torrent, output_filename):
+    """
+    Öffnet die Ausgabedatei(en) des Torrents, mit voller Größe vorallokiert.
+    Bei Multi-File-Torrents ist output_filename das Zielverzeichnis.
+    """
+    files = storage.files_from_torrent(torrent, output_filename)
+    return storage.Storage(files, torrent.piece_length)
+
+def download_file(sock, torrent, output_filename, window=None):
     """
     Downloaded alle Pieces und schreibt sie in eine Datei
     
     Parameters:
         sock: Socket-Verbindung zum Peer
-        torrent: Parsed torrent dict
+        torrent (torrent_file.Torrent): Metadaten
+        output_filename: Wo die Datei gespeichert wird
+        window (pipeline.RequestWindow): Aktiviert Pipelining, None = ein Request pro Round Trip
+    """
+    num_pieces = torrent.num_pieces
+
+    with open_storage(torrent, output_filename) as output:
+        for piece in range(num_pieces):
+            piece_data = download_piece(sock, piece, torrent, window)
+            output.write_piece(piece, piece_data)
+            output.wait_for_space()
+            print(f"Downloaded piece {piece}/{num_pieces}")
+
+def download_file_swarm(torrent, peers, info_hash, peer_id, output_filename,
+                        max_connections=swarm.DEFAULT_MAX_CONNECTIONS, download_limit=None, upload_limit=None,
+                        peer_download_limit=None, peer_upload_limit=None):
+    """
+    Downloaded alle Pieces von vielen Peers gleichzeitig (asyncio) und lädt
+    fertige Pieces über den Seeder an andere Peers hoch
+
+    Parameters:
+        torrent (torrent_file.Torrent): Metadaten
+        peers (list): [(ip, port)] vom Tracker
+        info_hash (bytes): 20-byte SHA1-Hash
+        peer_id (bytes): 20-byte Peer-ID
         output_filename: Wo die Datei gespeichert wird
+        max_connections (int): Maximale Anzahl gleichzeitiger Peer-Verbindungen
+        download_limit (float): Download-Limit in Bytes/s, None = unbegrenzt
+        upload_limit (float): Upload-Limit in Bytes/s, None = unbegrenzt
+        peer_download_limit (float): Download-Limit pro Peer in Bytes/s, None = unbegrenzt
+        peer_upload_limit (float): Upload-Limit pro Peer in Bytes/s, None = unbegrenzt
     """
-    num_pieces = len(torrent['info']['pieces']) // 20
-
-    for piece in range(num_pieces):
-        piece_length = peer_protocol.get_piece_length(torrent, piece)
-        piece_data = download_piece(sock, piece, torrent)
-        with open(output_filename, "wb") as f:
-            f.seek(piece * piece_length)
-            f.write(piece_data)
-        print(f"Downloaded piece {piece}/{num_pieces}")
\ No newline at end of file
+    with open_storage(torrent, output_filename) as output:
+        asyncio.run(download_and_seed(torrent, peers, info_hash, peer_id, output, max_connections,
+                                      download_limit, upload_limit, peer_download_limit, peer_upload_limit))
+
+async def download_and_seed(torrent, peers, info_hash, peer_id, output, max_connections,
+                            download_limit=None, upload_limit=None, peer_download_limit=None, peer_upload_limit=None):
+    limits = None
+    if download_limit or upload_limit or peer_download_limit or peer_upload_limit:
+        limits = bandwidth.BandwidthScheduler(download_limit, upload_limit, peer_download_rate=peer_download_limit,
+                                              peer_upload_rate=peer_upload_limit)
+    # Der Choker des Seeders bevorzugt Peers, von denen wir am schnellsten laden
+    engine = swarm.Swarm(torrent, info_hash, peer_id, None, max_connections, bandwidth=limits,
+                         drain=output.drain)
+    upload = seeder.Seeder(peer_id, download_rate=engine.download_rate, bandwidth=limits)
+    upload.add_torrent(torrent, output, Bitfield(torrent.num_pieces))
+    try:
+        await upload.start()
+    except OSError as e:
+        print(f"Listen on port {upload.port} failed, download only: {e}")
+
+    def on_piece(piece_index, piece_data):
+        output.write_piece(piece_index, piece_data)
+        upload.piece_completed(info_hash, piece_index)
+
+    engine.on_piece = on_piece
+    try:
+        await engine.run(peers)
+    finally:
+        await upload.close()
+        if limits is not None:
+            print(f"Bandwidth: {limits.stats()}")
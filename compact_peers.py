@@ -0,0 +1,44 @@
+import socket
+import struct
+
+# Entry sizes (BEP 23 / BEP 7)
+PEER_SIZE = 6           # 4-byte IPv4 address + 2-byte port
+PEER6_SIZE = 18         # 16-byte IPv6 address + 2-byte port
+
+_PEER = struct.Struct('>4sH')
+_PEER6 = struct.Struct('>16sH')
+
+
+def decode_peers(data, ipv6=False):
+    """
+    Decodes a compact peer list (tracker "peers"/"peers6" or the peer part of a
+    UDP announce response).
+
+    The entries are unpacked in one pass with struct.iter_unpack over a
+    memoryview and deduplicated on the raw bytes, so every distinct peer is
+    converted to a string only once. A truncated last entry is ignored.
+
+    Parameters:
+        data (bytes): concatenated 6-byte (IPv4) or 18-byte (IPv6) entries
+        ipv6 (bool): entries are 18 bytes
+
+    Returns:
+        list: [(ip, port)] without duplicates, in order of first appearance
+    """
+    entry = _PEER6 if ipv6 else _PEER
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % entry.size]
+    unique = dict.fromkeys(entry.iter_unpack(view))
+    if ipv6:
+        ntop = socket.inet_ntop
+        return [(ntop(socket.AF_INET6, ip), port) for ip, port in unique]
+    ntoa = socket.inet_ntoa
+    return [(ntoa(ip), port) for ip, port in unique]
+
+
+def merge_peers(*peer_lists):
+    """
+    Returns:
+        list: [(ip, port)] of all lists without duplicates, in order of first appearance
+    """
+    return list(dict.fromkeys(peer for peers in peer_lists for peer in peers))
@@ -1,7 +1,21 @@
-from client import *
+import asyncio
+import os
+import sys
 
-torrent_file = "linuxmint-22.2-cinnamon-64bit.iso.torrent"
-torrent, info_hash = load_torrent(torrent_file)
-peers, peer_id = get_peers_from_tracker(torrent, info_hash)
-sock = connect_to_peer(peers, info_hash, peer_id)
-piece = download_file(sock, torrent, "out.iso")
\ No newline at end of file
+from client import load_torrent
+from session import Session
+from storage import path_component
+
+torrent_files = sys.argv[1:] or ["linuxmint-22.2-cinnamon-64bit.iso.torrent"]
+
+
+async def main():
+    async with Session(resume_dir=".resume") as session:
+        for torrent_file in torrent_files:
+            torrent, info_hash = load_torrent(torrent_file)
+            # The name comes from the torrent file, it must not leave the download directory
+            await session.add_torrent(torrent, os.path.join("downloads", path_component(torrent.name)))
+        await session.wait_complete()
+        print(session.stats())
+
+asyncio.run(main())
@@ -0,0 +1,59 @@
+import time
+
+# Defaults
+BASE_BACKOFF = 30.0         # wait after the first failure, doubled per further failure
+MAX_BACKOFF = 1800.0
+MAX_FAILURES = 8            # peers failing this often in a row are given up
+
+
+class PeerBackoff:
+    """
+    Failure record of peers we tried to connect to.
+
+    Every failed connect or handshake doubles the time until the peer is
+    tried again, a successful handshake clears its record. Peers that
+    never failed are preferred when candidates are ordered.
+    """
+
+    def __init__(self, base=BASE_BACKOFF, maximum=MAX_BACKOFF, max_failures=MAX_FAILURES):
+        self.base = base
+        self.maximum = maximum
+        self.max_failures = max_failures
+        self.failures = {}      # (ip, port) -> (consecutive failures, retry_at)
+
+    def failed(self, peer, now=None):
+        now = time.monotonic() if now is None else now
+        count = self.failures.get(peer, (0, 0.0))[0] + 1
+        delay = min(self.base * 2 ** (count - 1), self.maximum)
+        self.failures[peer] = (count, now + delay)
+
+    def succeeded(self, peer):
+        self.failures.pop(peer, None)
+
+    def is_ready(self, peer, now=None):
+        """
+        Returns:
+            bool: False while the peer is backing off or after too many failures
+        """
+        record = self.failures.get(peer)
+        if record is None:
+            return True
+        count, retry_at = record
+        return count < self.max_failures and retry_at <= (time.monotonic() if now is None else now)
+
+    def gave_up(self, peer):
+        """
+        Returns:
+            bool: True once the peer failed max_failures times in a row
+        """
+        record = self.failures.get(peer)
+        return record is not None and record[0] >= self.max_failures
+
+    def order(self, peers, now=None):
+        """
+        Returns:
+            list: ready peers, those without failures first, otherwise in the given order
+        """
+        now = time.monotonic() if now is None else now
+        ready = [peer for peer in peers if self.is_ready(peer, now)]
+        return sorted(ready, key=lambda peer: peer in self.failures)
@@ -2,6 +2,29 @@ import struct
 import socket
 import hashlib
 import torrent_file
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from peer_backoff import PeerBackoff
+
+# Message IDs
+MSG_CHOKE = 0
+MSG_UNCHOKE = 1
+MSG_INTERESTED = 2
+MSG_NOT_INTERESTED = 3
+MSG_HAVE = 4
+MSG_BITFIELD = 5
+MSG_REQUEST = 6
+MSG_PIECE = 7
+MSG_CANCEL = 8
+
+HANDSHAKE_LENGTH = 68
+MAX_MESSAGE_LENGTH = 2 * 1024 * 1024
+IOV_MAX = 1024
+DIAL_TIMEOUT = 5.0
+MESSAGE_TIMEOUT = 120.0     # Peers senden spätestens alle 2 Minuten ein keep-alive
+DIAL_FAN_OUT = 16
+
+# Fehler-Statistik aller find_working_peer-Aufrufe ohne eigenes backoff
+dial_backoff = PeerBackoff()
 
 def build_handshake(info_hash, peer_id):
     """    
@@ -16,7 +39,7 @@ def build_handshake(info_hash, peer_id):
     return packet
 
 
-def send_handshake(peer_ip, peer_port, info_hash, peer_id, timeout=15.0):
+def send_handshake(peer_ip, peer_port, info_hash, peer_id, timeout=DIAL_TIMEOUT):
     """
     Verbindet zu einem Peer und tauscht Handshakes aus.
     
@@ -25,23 +48,22 @@ def send_handshake(peer_ip, peer_port, info_hash, peer_id, timeout=15.0):
         peer_port (int): Port des Peers
         info_hash (bytes): 20-byte SHA1-Hash
         peer_id (bytes): 20-byte Peer-ID
-        timeout (float): Connection timeout
+        timeout (float): Timeout für Connect und Handshake, danach gilt MESSAGE_TIMEOUT
         
     Returns:
         tuple: (socket, peer_handshake: bytes)
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(timeout)
-    print("Shake hands with",peer_ip, peer_port)
-
-    sock.connect((peer_ip, peer_port))
-    handshake = build_handshake(info_hash, peer_id)
-    sock.sendall(handshake)
-    peer_handshake = sock.recv(68)
-
-    return (sock, peer_handshake)
-
-
+    sock = socket.create_connection((peer_ip, peer_port), timeout)
+    try:
+        sock.sendall(build_handshake(info_hash, peer_id))
+        # recv(68) kann weniger liefern, deshalb bis 68 Bytes da sind
+        peer_handshake = recv_exact(sock, HANDSHAKE_LENGTH)
+    except BaseException:
+        sock.close()
+        raise
+    # Der kurze Dial-Timeout würde jede längere Pause (z.B. bis zum nächsten Unchoke) abbrechen
+    sock.settimeout(MESSAGE_TIMEOUT)
+    return (sock, bytes(peer_handshake))
 
 
 def parse_handshake(handshake_data, info_hash_og):
@@ -71,35 +93,87 @@ def parse_handshake(handshake_data, info_hash_og):
     
     return dic
 
-def find_working_peer(peers, info_hash, peer_id):
-    "Probiert peers bis einer antwortet."
+def dial_peer(peer_ip, peer_port, info_hash, peer_id, timeout=DIAL_TIMEOUT):
+    """
+    Handshake mit einem Peer.
 
-    for peer_ip, peer_port in peers:
-        print(f"Try {peer_ip}: {peer_port}...")
+    Returns:
+        tuple: (socket, peer_info: dict von parse_handshake)
+    """
+    sock, peer_handshake = send_handshake(peer_ip, peer_port, info_hash, peer_id, timeout)
+    try:
+        peer_info = parse_handshake(peer_handshake, info_hash)
+    except BaseException:
+        sock.close()
+        raise
+    return sock, peer_info
+
+def find_working_peer(peers, info_hash, peer_id, max_pending=DIAL_FAN_OUT, timeout=DIAL_TIMEOUT, backoff=None):
+    """
+    Wählt bis zu max_pending Peers gleichzeitig an, der erste erfolgreiche Handshake gewinnt.
 
-        try:
-            sock, peer_handshake = send_handshake(peer_ip, peer_port, info_hash, peer_id)
-            #Parse
-            peer_info = parse_handshake(peer_handshake, info_hash)
-            print(f"Erfolgreicher Handshake mit {peer_ip}:{peer_port}")
-            print(f"Peer ID: {peer_info['peer_id']}")
+    Parameters:
+        peers (list): [(ip, port)]
+        max_pending (int): max. gleichzeitige Verbindungsversuche
+        timeout (float): Timeout für Connect und Handshake
+        backoff (peer_backoff.PeerBackoff): Fehler-Statistik, Peers im Backoff werden übersprungen,
+            None = dial_backoff, bleibt über Aufrufe hinweg erhalten
 
+    Returns:
+        tuple: (socket, peer_info)
+    """
+    if backoff is None:
+        backoff = dial_backoff
+    candidates = backoff.order(peers)
+    if not candidates:
+        raise Exception("No peer to connect to!")
+
+    pool = ThreadPoolExecutor(max_workers=min(max_pending, len(candidates)), thread_name_prefix="dial")
+    futures = {pool.submit(dial_peer, ip, port, info_hash, peer_id, timeout): (ip, port)
+               for ip, port in candidates}
+    winner = None
+    try:
+        for future in as_completed(futures):
+            peer = futures[future]
+            try:
+                sock, peer_info = future.result()
+            except Exception as e:
+                backoff.failed(peer)
+                print(f"Fehler bei {peer[0]}:{peer[1]}: {e}")
+                continue
+            backoff.succeeded(peer)
+            winner = future
+            print(f"Erfolgreicher Handshake mit {peer[0]}:{peer[1]}")
+            print(f"Peer ID: {peer_info['peer_id']}")
             return sock, peer_info
-        except Exception as e:
-            print(f"Fehler: {e}")
-            continue
+    finally:
+        # Verlierer: noch nicht gestartete abbrechen, später fertige Sockets schließen
+        for future in futures:
+            if future is not winner and not future.cancel():
+                future.add_done_callback(close_dialed)
+        pool.shutdown(wait=False)
+    raise Exception("No working peer found!")
+
+def close_dialed(future):
+    if not future.cancelled() and future.exception() is None:
+        sock, _ = future.result()
+        sock.close()
 
 
 def recv_exact(sock, n):
     """Empfängt exakt n bytes (robuster als sock.recv)"""
-    data = b''
-    while len(data) < n:
-        chunk = sock.recv(n-len(data))
-        if not chunk:
-            raise Exception("Connection closed")
-        data += chunk
+    data = bytearray(n)
+    recv_into_exact(sock, memoryview(data))
     return data
 
+def recv_into_exact(sock, view):
+    """Füllt den memoryview komplett mit sock.recv_into, ohne Zwischenkopien"""
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise Exception("Connection closed")
+        view = view[received:]
+
 def receive_message(sock):
     """
     Empfängt eine BitTorrent-Message vom Peer.
@@ -108,26 +182,140 @@ def receive_message(sock):
         sock: TCP-Socket-Verbindung
         
     Returns:
-        tuple: (message_id: int, payload: bytes)
+        tuple: (message_id: int or None for keep-alive, payload: memoryview)
     """
 
     # Format: Bytes 0-3, Länge message, Byte 4 message_id (Typ), Bytes 5+ payload
     length_bytes = recv_exact(sock, 4)
     length = struct.unpack('>I', length_bytes)
     length = length[0]
+    if length == 0:
+        # Keep-alive
+        return None, memoryview(b'')
+    if length > MAX_MESSAGE_LENGTH:
+        raise ValueError(f"Message too long: {length} bytes")
     unpack = recv_exact(sock, length)
 
     message_id = unpack[0]
-    payload = unpack[1:]
+    payload = memoryview(unpack)[1:]
 
     return  message_id, payload
 
+
+class MessageReader:
+    """
+    Empfängt Messages eines Sockets in einen wiederverwendeten Puffer.
+
+    Der zurückgegebene Payload ist ein memoryview in diesen Puffer und nur
+    bis zum nächsten receive() gültig; Blöcke werden daraus direkt in den
+    Piece-Puffer kopiert.
+    """
+
+    def __init__(self, sock, size=16384 + 13, max_length=MAX_MESSAGE_LENGTH):
+        self.sock = sock
+        self.max_length = max_length
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def receive(self):
+        """
+        Returns:
+            tuple: (message_id: int or None for keep-alive, payload: memoryview)
+        """
+        recv_into_exact(self.sock, self.view[:4])
+        length = struct.unpack_from('>I', self.buffer)[0]
+        if length == 0:
+            return None, self.view[:0]
+        if length > self.max_length:
+            raise ValueError(f"Message too long: {length} bytes")
+        if length > len(self.buffer):
+            # Neuer Puffer statt resize, alte memoryviews bleiben gültig
+            self.buffer = bytearray(length)
+            self.view = memoryview(self.buffer)
+        recv_into_exact(self.sock, self.view[:length])
+        return self.buffer[0], self.view[1:length]
+
+class MessageDecoder:
+    """
+    Zerlegt einen Bytestrom in Messages, unabhängig davon wie er gestückelt ist.
+
+    feed() nimmt beliebige Chunks (großes recv oder Protocol.data_received)
+    und gibt alle darin vollständigen Messages zurück. Liegt eine Message
+    komplett im Chunk, ist der Payload ein memoryview auf den Chunk, ohne
+    Kopie; angefangene Messages werden in einem eigenen Puffer ihrer
+    Länge gesammelt.
+    """
+
+    def __init__(self, max_length=MAX_MESSAGE_LENGTH):
+        self.max_length = max_length
+        self.header = bytearray()
+        self.body = None        # Puffer der angefangenen Message
+        self.filled = 0
+
+    def feed(self, data):
+        """
+        Returns:
+            list: [(message_id: int or None for keep-alive, payload: memoryview)]
+        """
+        messages = []
+        view = memoryview(data)
+        pos = 0
+        end = len(view)
+        while pos < end:
+            if self.body is not None:
+                n = min(len(self.body) - self.filled, end - pos)
+                self.body[self.filled:self.filled + n] = view[pos:pos + n]
+                self.filled += n
+                pos += n
+                if self.filled == len(self.body):
+                    messages.append((self.body[0], memoryview(self.body)[1:]))
+                    self.body = None
+                continue
+
+            if not self.header and end - pos >= 4:
+                length = struct.unpack_from('>I', view, pos)[0]
+                pos += 4
+            else:
+                n = min(4 - len(self.header), end - pos)
+                self.header += view[pos:pos + n]
+                pos += n
+                if len(self.header) < 4:
+                    break
+                length = struct.unpack('>I', self.header)[0]
+                self.header.clear()
+
+            if length == 0:
+                messages.append((None, view[:0]))
+            elif length > self.max_length:
+                raise ValueError(f"Message too long: {length} bytes")
+            elif end - pos >= length:
+                messages.append((view[pos], view[pos + 1:pos + length]))
+                pos += length
+            else:
+                self.body = bytearray(length)
+                self.filled = 0
+        return messages
+
+def build_interested():
+    """Baut 'interested' Message (ID 2)"""
+    return struct.pack('>IB', 1, MSG_INTERESTED)
+
 def send_interested(sock):
     """Sendet 'interested' Message (ID 2)"""
 
-    packet = struct.pack('>IB', 1, 2)
+    packet = build_interested()
     sock.sendall(packet)
 
+def build_request(piece_index, begin, block_length = 16384):
+    """
+    Baut eine 'request' Message (ID 6).
+
+    Returns:
+        bytes: 17-byte Request-Message
+    """
+    length = 13
+    return struct.pack('>IBIII', length, MSG_REQUEST, piece_index, begin, block_length)
+
 def send_request(sock, piece_index, begin, block_length = 16384):
     """
     Fordert einen Block eines Piece an.
@@ -139,31 +327,161 @@ def send_request(sock, piece_index, begin, block_length = 16384):
         block_length (int): Größe des Blocks (meist 16384)
     """
 
-    length = 13
-    message_id = 6
-    
-    packet = struct.pack('>IBIII', length, message_id, piece_index, begin, block_length)
+    packet = build_request(piece_index, begin, block_length)
     sock.sendall(packet)
 
 
+class OutgoingQueue:
+    """
+    Sammelt ausgehende Messages einer Verbindung und sendet sie gebündelt.
+
+    Kleine Messages (request, have, cancel, interested, ...) werden mit
+    struct.pack_into in einen wiederverwendeten Puffer gepackt; große Payloads
+    (z.B. Piece-Daten) werden nicht kopiert, sondern als eigenes Segment
+    angehängt. flush() schickt alles mit einem sendmsg (Scatter-Liste),
+    einmal pro Durchlauf der Event-Loop.
+    """
+
+    COPY_LIMIT = 1024     # größere Payloads werden als eigenes Segment gesendet
+
+    def __init__(self, size=64 * 17):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.sealed = 0         # Anfang des noch nicht in segments eingetragenen Bereichs
+        self.segments = []
+        self.num_messages = 0
+
+    def __len__(self):
+        return self.num_messages
+
+    def _seal(self):
+        if self.length > self.sealed:
+            self.segments.append(self.view[self.sealed:self.length])
+            self.sealed = self.length
+
+    def _reserve(self, n):
+        if self.length + n <= len(self.buffer):
+            return
+        # Neuer Puffer statt resize: die Segmente zeigen noch auf den alten
+        self._seal()
+        self.buffer = bytearray(max(2 * len(self.buffer), n))
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.sealed = 0
+
+    def _pack(self, fmt, *values):
+        size = struct.calcsize(fmt)
+        self._reserve(size)
+        struct.pack_into(fmt, self.buffer, self.length, *values)
+        self.length += size
+        self.num_messages += 1
+
+    def choke(self):
+        self._pack('>IB', 1, MSG_CHOKE)
+
+    def unchoke(self):
+        self._pack('>IB', 1, MSG_UNCHOKE)
+
+    def interested(self):
+        self._pack('>IB', 1, MSG_INTERESTED)
+
+    def not_interested(self):
+        self._pack('>IB', 1, MSG_NOT_INTERESTED)
+
+    def have(self, piece_index):
+        self._pack('>IBI', 5, MSG_HAVE, piece_index)
+
+    def request(self, piece_index, begin, block_length = 16384):
+        self._pack('>IBIII', 13, MSG_REQUEST, piece_index, begin, block_length)
+
+    def cancel(self, piece_index, begin, block_length = 16384):
+        self._pack('>IBIII', 13, MSG_CANCEL, piece_index, begin, block_length)
+
+    def piece(self, piece_index, begin, block):
+        """'piece' Message (ID 7), der Block wird nicht kopiert"""
+        self._pack('>IBII', 9 + len(block), MSG_PIECE, piece_index, begin)
+        self.raw(block)
+
+    def message(self, message_id, payload=b''):
+        """Beliebige Message, z.B. bitfield oder piece"""
+        self._pack('>IB', 1 + len(payload), message_id)
+        self.raw(payload)
+
+    def raw(self, data):
+        if len(data) >= self.COPY_LIMIT:
+            self._seal()
+            self.segments.append(memoryview(data))
+            return
+        self._reserve(len(data))
+        self.buffer[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    def _take_segments(self):
+        self._seal()
+        segments = self.segments
+        self.segments = []
+        self.length = 0
+        self.sealed = 0
+        self.num_messages = 0
+        return segments
+
+    def flush(self, sock):
+        """Sendet alle gesammelten Messages über einen blockierenden Socket"""
+        segments = self._take_segments()
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(b''.join(segments))
+            return
+        while segments:
+            sent = sock.sendmsg(segments[:IOV_MAX])
+            # Teilweise gesendet: fertige Segmente entfernen, angefangenes kürzen
+            while sent:
+                if sent >= len(segments[0]):
+                    sent -= len(segments.pop(0))
+                else:
+                    segments[0] = segments[0][sent:]
+                    sent = 0
+
+    def flush_to(self, writer):
+        """Übergibt alle gesammelten Messages einem asyncio StreamWriter / Transport"""
+        segments = self._take_segments()
+        if segments:
+            # Der Transport darf den wiederverwendeten Puffer nicht referenzieren
+            writer.write(b''.join(segments))
+
 
 def parse_piece(payload):
-    """Parst Piece-Message Payload"""
-    piece_index = struct.unpack('>I', payload[0:4])[0]
-    begin = struct.unpack('>I', payload[4:8])[0]
-    block_data = payload[8:]
+    """
+    Parst Piece-Message Payload
+
+    Returns:
+        tuple: (piece_index, begin, block_data: memoryview auf den Payload, keine Kopie)
+    """
+    piece_index, begin = struct.unpack_from('>II', payload)
+    block_data = memoryview(payload)[8:]
     return piece_index, begin, block_data
 
+def parse_request(payload):
+    """
+    Parst Payload einer 'request' oder 'cancel' Message
+
+    Returns:
+        tuple: (piece_index, begin, block_length)
+    """
+    if len(payload) != 12:
+        raise ValueError(f"Request payload has {len(payload)} bytes, expected 12")
+    return struct.unpack('>III', payload)
+
 
 def validate_piece(piece_data, expected_hash):
     """Prüft ob Piece korrekt ist"""
     actual_hash = hashlib.sha1(piece_data).digest()
-    print(f"\nExpected hash: {expected_hash.hex()}")
-    print(f"Actual hash:   {actual_hash.hex()}")
     return actual_hash == expected_hash
 
 def get_piece_length(torrent, piece_index):
     """Gibt die Größe eines bestimmten Piece zurück"""
+    if isinstance(torrent, torrent_file.Torrent):
+        return torrent.piece_size(piece_index)
     total_size = torrent_file.get_total_size(torrent)
     piece_length = torrent['info']['piece length']
     num_pieces = len(torrent['info']['pieces']) // 20
@@ -177,4 +495,4 @@ def get_piece_length(torrent, piece_index):
         else:
             return last_piece_length
     else:
-        return piece_length  # Normale Piece
\ No newline at end of file
+        return piece_length  # Normale Piece
@@ -0,0 +1,259 @@
+import random
+import re
+from array import array
+
+# Piece states
+WANTED = 0
+IN_PROGRESS = 1
+DONE = 2
+
+PICK_BUDGET = 256      # pieces a pick looks at, independent of the torrent size
+
+# Set bit positions of every byte value, MSB = lowest piece index
+BIT_POSITIONS = tuple(tuple(bit for bit in range(8) if byte >> (7 - bit) & 1) for byte in range(256))
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
+class Bitfield:
+    """
+    Compact set of piece indices, one bit per piece (wire format of message 5).
+    """
+
+    __slots__ = ('length', 'bits', 'count')
+
+    def __init__(self, length, bits=None):
+        self.length = length
+        if bits is None:
+            bits = bytearray((length + 7) // 8)
+        self.bits = bits
+        self.count = sum(len(BIT_POSITIONS[byte]) for byte in bits)
+
+    @classmethod
+    def from_payload(cls, payload, length):
+        """
+        Parses the payload of a bitfield message.
+
+        Parameters:
+            payload (bytes): bitfield message payload
+            length (int): number of pieces in the torrent
+        """
+        expected = (length + 7) // 8
+        if len(payload) != expected:
+            raise ValueError(f"Bitfield has {len(payload)} bytes, expected {expected}")
+        bits = bytearray(payload)
+        spare = expected * 8 - length
+        if spare and bits[-1] & ((1 << spare) - 1):
+            raise ValueError("Spare bits of bitfield are set")
+        return cls(length, bits)
+
+    @classmethod
+    def full(cls, length):
+        bits = bytearray(b'\xff' * ((length + 7) // 8))
+        spare = len(bits) * 8 - length
+        if spare:
+            bits[-1] &= 0xff << spare & 0xff
+        return cls(length, bits)
+
+    def __contains__(self, index):
+        return self.bits[index >> 3] >> (7 - (index & 7)) & 1 == 1
+
+    def add(self, index):
+        """
+        Returns:
+            bool: True if the bit was not set before
+        """
+        if not 0 <= index < self.length:
+            raise IndexError(f"Piece index {index} out of range")
+        mask = 0x80 >> (index & 7)
+        if self.bits[index >> 3] & mask:
+            return False
+        self.bits[index >> 3] |= mask
+        self.count += 1
+        return True
+
+    def is_complete(self):
+        return self.count == self.length
+
+    def indices(self):
+        """Yields all set piece indices, skipping empty bytes"""
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                base = byte_index << 3
+                for bit in BIT_POSITIONS[byte]:
+                    yield base + bit
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+
+class PiecePicker:
+    """
+    Rarest-first piece selection.
+
+    Keeps an availability counter per piece and buckets the wanted pieces by
+    that counter, so a have message moves one piece between two buckets and a
+    pick only looks at the rarest buckets. Seeds are counted once in
+    `num_seeds` instead of touching every counter.
+
+    Parameters:
+        num_pieces (int): number of pieces in the torrent
+    """
+
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.availability = array('I', [0]) * num_pieces
+        self.state = bytearray(num_pieces)
+        self.position = array('I', range(num_pieces))
+        self.buckets = {0: list(range(num_pieces))} if num_pieces else {}    # availability -> [piece_index]
+        self.wanted = Bitfield.full(num_pieces).bits     # bit set = piece is in a bucket
+        self.seeds = set()
+        self.num_done = 0
+
+    @property
+    def num_seeds(self):
+        return len(self.seeds)
+
+    def _bucket_remove(self, index):
+        bucket = self.buckets[self.availability[index]]
+        pos = self.position[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[pos] = last
+            self.position[last] = pos
+        if not bucket:
+            del self.buckets[self.availability[index]]
+        self.wanted[index >> 3] &= ~(0x80 >> (index & 7))
+
+    def _bucket_add(self, index):
+        bucket = self.buckets.setdefault(self.availability[index], [])
+        self.position[index] = len(bucket)
+        bucket.append(index)
+        self.wanted[index >> 3] |= 0x80 >> (index & 7)
+
+    def _increment(self, index, delta):
+        if self.state[index] == WANTED:
+            self._bucket_remove(index)
+            self.availability[index] += delta
+            self._bucket_add(index)
+        else:
+            self.availability[index] += delta
+
+    def peer_bitfield(self, bitfield):
+        """Registers the pieces of a newly connected peer"""
+        if bitfield.is_complete():
+            self.seeds.add(bitfield)
+            return
+        for index in bitfield.indices():
+            self._increment(index, 1)
+
+    def peer_have(self, bitfield, index):
+        """Registers a have message; the bit must already be set in `bitfield`"""
+        if bitfield not in self.seeds:
+            self._increment(index, 1)
+
+    def peer_lost(self, bitfield):
+        """Removes a disconnected peer from the availability counters"""
+        if bitfield in self.seeds:
+            self.seeds.discard(bitfield)
+            return
+        for index in bitfield.indices():
+            self._increment(index, -1)
+
+    def get_availability(self, index):
+        return self.availability[index] + len(self.seeds)
+
+    def pick(self, bitfield):
+        """
+        Picks the rarest wanted piece the peer has, ties broken at random,
+        and marks it as in progress.
+
+        Buckets are scanned rarest first while they fit into PICK_BUDGET
+        probes. After that the peer's wanted pieces are looked at directly,
+        again at most PICK_BUDGET of them, so the cost of a pick does not
+        grow with the number of pieces.
+
+        Returns:
+            int: piece index, or None if the peer has nothing we want
+        """
+        is_seed = bitfield in self.seeds
+        scanned = 0
+        for count in sorted(self.buckets):
+            if count == 0 and not is_seed:
+                # Only seeds have pieces that no counted peer has
+                continue
+            bucket = self.buckets[count]
+            size = len(bucket)
+            if not is_seed and scanned + size > PICK_BUDGET:
+                return self._pick_from_bitfield(bitfield, count)
+            scanned += size
+            start = random.randrange(size)
+            for offset in range(size):
+                index = bucket[(start + offset) % size]
+                if index in bitfield:
+                    return self._take(index)
+        return None
+
+    def _pick_from_bitfield(self, bitfield, lowest):
+        """
+        Rarest of up to PICK_BUDGET wanted pieces of the peer, starting at a
+        random position. The pieces both sides care about are found with one
+        AND over the bitfields; a piece with availability `lowest` (no rarer
+        one is left) ends the search right away.
+        """
+        size = len(self.wanted)
+        common = (int.from_bytes(bitfield.bits, 'big') & int.from_bytes(self.wanted, 'big')).to_bytes(size, 'big')
+        start = random.randrange(size) if size else 0
+        best = None
+        ties = []
+        budget = PICK_BUDGET
+        for begin, end in ((start, size), (0, start)):
+            for match in NONZERO_BYTE.finditer(common, begin, end):
+                base = match.start() << 3
+                for bit in BIT_POSITIONS[common[match.start()]]:
+                    index = base + bit
+                    count = self.availability[index]
+                    if best is None or count < best:
+                        best = count
+                        ties = [index]
+                    elif count == best:
+                        ties.append(index)
+                budget -= len(BIT_POSITIONS[common[match.start()]])
+                if budget <= 0 or best == lowest:
+                    return self._take(random.choice(ties))
+        if not ties:
+            return None
+        return self._take(random.choice(ties))
+
+    def _take(self, index):
+        self._bucket_remove(index)
+        self.state[index] = IN_PROGRESS
+        return index
+
+    def release(self, index):
+        """Puts an in-progress piece back (peer gone or hash mismatch)"""
+        if self.state[index] == IN_PROGRESS:
+            self.state[index] = WANTED
+            self._bucket_add(index)
+
+    def complete(self, index):
+        """
+        Returns:
+            bool: False if the piece was already done
+        """
+        if self.state[index] == DONE:
+            return False
+        if self.state[index] == WANTED:
+            self._bucket_remove(index)
+        self.state[index] = DONE
+        self.num_done += 1
+        return True
+
+    def has_wanted(self):
+        """False once every missing piece is in progress (endgame)"""
+        return bool(self.buckets)
+
+    def is_complete(self):
+        return self.num_done == self.num_pieces
+
+    def remaining(self):
+        return self.num_pieces - self.num_done
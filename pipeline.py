@@ -0,0 +1,146 @@
+import time
+from collections import deque
+
+# Block / window defaults
+BLOCK_SIZE = 16384
+DEFAULT_WINDOW = 8
+MIN_WINDOW = 2
+MAX_WINDOW = 256
+RATE_WINDOW = 5.0   # seconds of history used for the rolling rate
+HEADROOM = 2        # keep twice the bandwidth-delay product in flight
+
+
+class RateMeter:
+    """
+    Rolling transfer rate over the last `window` seconds.
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.samples = deque()
+        self.bytes_in_window = 0
+        self.total = 0
+        self.started = None
+
+    def add(self, num_bytes, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        self.samples.append((now, num_bytes))
+        self.bytes_in_window += num_bytes
+        self.total += num_bytes
+        self._expire(now)
+
+    def _expire(self, now):
+        limit = now - self.window
+        while self.samples and self.samples[0][0] < limit:
+            _, num_bytes = self.samples.popleft()
+            self.bytes_in_window -= num_bytes
+
+    def rate(self, now=None):
+        """
+        Returns:
+            float: bytes per second
+        """
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+        if self.started is None:
+            return 0.0
+        elapsed = min(self.window, now - self.started)
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes_in_window / elapsed
+
+
+class RequestWindow:
+    """
+    Outstanding block requests of one peer connection.
+
+    The window size follows the bandwidth-delay product of the connection:
+    rate * min_rtt / BLOCK_SIZE, times HEADROOM. While the connection is not
+    yet link bound every received block grows the window by one, which
+    roughly doubles it per round trip.
+    """
+
+    def __init__(self, size=DEFAULT_WINDOW, min_size=MIN_WINDOW, max_size=MAX_WINDOW):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.outstanding = {}   # (piece_index, begin) -> (sent_at, length)
+        self.meter = RateMeter()
+        self.min_rtt = None
+
+    def has_room(self):
+        return len(self.outstanding) < self.size
+
+    def on_request(self, piece_index, begin, length, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.outstanding[(piece_index, begin)] = (now, length)
+
+    def on_block(self, piece_index, begin, length, now=None):
+        """
+        Registers an arrived block and resizes the window.
+
+        Returns:
+            bool: False if the block was never requested (or already arrived)
+
+        Raises:
+            ValueError: the block is shorter or longer than requested, a short block
+                would leave the rest of the range unrequested forever
+        """
+        entry = self.outstanding.get((piece_index, begin))
+        if entry is None:
+            return False
+        sent_at, requested = entry
+        if length != requested:
+            raise ValueError(f"Block {piece_index}/{begin} has {length} bytes, requested {requested}")
+        del self.outstanding[(piece_index, begin)]
+        if now is None:
+            now = time.monotonic()
+        rtt = now - sent_at
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        self.meter.add(length, now)
+        self._resize(now)
+        return True
+
+    def _resize(self, now):
+        target = self.target_size(now)
+        if target > self.size:
+            self.size += 1
+        elif target < self.size:
+            self.size -= 1
+
+    def target_size(self, now=None):
+        """Window size matching the bandwidth-delay product of the peer"""
+        if not self.min_rtt:
+            return self.max_size
+        bdp = self.meter.rate(now) * self.min_rtt
+        target = int(HEADROOM * bdp / BLOCK_SIZE) + 1
+        return max(self.min_size, min(self.max_size, target))
+
+    def cancel(self, piece_index, begin):
+        """
+        Forgets one outstanding request without a rate sample (e.g. endgame cancel).
+
+        Returns:
+            bool: False if the request was not outstanding
+        """
+        return self.outstanding.pop((piece_index, begin), None) is not None
+
+    def cancel_all(self):
+        """
+        Forgets all outstanding requests (e.g. after a choke).
+
+        Returns:
+            list: [(piece_index, begin, length)] of the dropped requests
+        """
+        dropped = [(index, begin, length) for (index, begin), (_, length) in self.outstanding.items()]
+        self.outstanding.clear()
+        return dropped
+
+    def rate(self, now=None):
+        return self.meter.rate(now)
@@ -0,0 +1,222 @@
+import asyncio
+import os
+
+from bencode import bencode_encode, decode
+from piece_picker import Bitfield
+from verifier import DEFAULT_WORKERS, PieceVerifier
+
+# Defaults
+RESUME_VERSION = 1
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+REHASH_QUEUE = 2 * DEFAULT_WORKERS  # pieces read ahead of the hashing threads
+
+
+def resume_path(resume_dir, info_hash):
+    return os.path.join(resume_dir, info_hash.hex() + '.resume')
+
+
+def file_states(file_map):
+    """
+    Returns:
+        list: [size, mtime_ns] per file of the torrent, [] if the file does not exist
+    """
+    states = []
+    for path in file_map.paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            states.append([])
+            continue
+        states.append([stat.st_size, stat.st_mtime_ns])
+    return states
+
+
+def encode_resume(info_hash, have, states):
+    return bencode_encode({
+        'version': RESUME_VERSION,
+        'info-hash': info_hash,
+        'pieces': have.to_bytes(),
+        'files': states,
+    })
+
+
+def decode_resume(data, torrent, num_files):
+    """
+    Returns:
+        tuple: (piece_picker.Bitfield, [[size, mtime_ns] or []] per file)
+
+    Raises:
+        ValueError: data of another torrent, another version or corrupt
+    """
+    resume, _ = decode(data)
+    if not isinstance(resume, dict) or resume.get('version') != RESUME_VERSION:
+        raise ValueError("Unknown resume data version")
+    if resume.get('info-hash') != torrent.info_hash:
+        raise ValueError("Resume data of another torrent")
+    states = resume.get('files')
+    if not isinstance(states, list) or len(states) != num_files:
+        raise ValueError("Resume data does not match the file list")
+    return Bitfield.from_payload(resume.get('pieces', b''), torrent.num_pieces), states
+
+
+def write_atomic(path, data):
+    """Writes a temporary file and renames it over `path`, readers see the old or the new data"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def pieces_of_files(file_map, piece_length, file_indices):
+    """
+    Returns:
+        list: sorted indices of all pieces that overlap one of the files
+    """
+    pieces = set()
+    start = 0
+    starts = []
+    for length in file_map.lengths:
+        starts.append(start)
+        start += length
+    for file_index in file_indices:
+        length = file_map.lengths[file_index]
+        if length > 0:
+            first = starts[file_index] // piece_length
+            last = (starts[file_index] + length - 1) // piece_length
+            pieces.update(range(first, last + 1))
+    return sorted(pieces)
+
+
+async def rehash(storage, torrent, pieces, verifier):
+    """
+    Reads the pieces and checks their hashes on the verifier's threads,
+    REHASH_QUEUE pieces at a time.
+
+    Returns:
+        list: indices of the pieces whose data matches
+    """
+    semaphore = asyncio.Semaphore(REHASH_QUEUE)
+
+    async def check(piece_index):
+        async with semaphore:
+            try:
+                data = await asyncio.to_thread(storage.read_piece, piece_index, torrent.piece_size(piece_index))
+            except (OSError, EOFError):
+                return False
+            return await asyncio.wrap_future(verifier.submit(piece_index, data, torrent.piece_hash(piece_index)))
+
+    results = await asyncio.gather(*(check(piece_index) for piece_index in pieces))
+    return [piece_index for piece_index, ok in zip(pieces, results) if ok]
+
+
+async def restore(path, torrent, storage, verifier=None):
+    """
+    Verified pieces on disk at startup.
+
+    The saved bitfield is trusted for every file whose size and mtime are
+    unchanged since the checkpoint. Pieces that touch a changed file (or one
+    whose size differs from the torrent's) are rehashed in parallel, pieces on
+    missing or empty files are dropped. Without (usable)
+    resume data every existing file counts as changed.
+
+    Parameters:
+        path (str): resume file, see resume_path
+        storage (storage.Storage): output files of the torrent
+        verifier (verifier.PieceVerifier): hashing threads, a private pool is used if None
+
+    Returns:
+        piece_picker.Bitfield: pieces that need no download
+    """
+    file_map = storage.file_map
+    current = await asyncio.to_thread(file_states, file_map)
+    try:
+        with open(path, 'rb') as file:
+            have, saved = decode_resume(file.read(), torrent, len(current))
+    except FileNotFoundError:
+        have, saved = Bitfield(torrent.num_pieces), [[]] * len(current)
+    except (OSError, ValueError, TypeError, IndexError) as e:
+        print(f"Resume data {path} unusable, rehashing: {e!r}")
+        have, saved = Bitfield(torrent.num_pieces), [[]] * len(current)
+
+    # Empty files never get written, truncated ones lost their data
+    missing = [file_index for file_index, state in enumerate(current)
+               if file_map.lengths[file_index] > 0 and (not state or state[0] == 0)]
+    changed = [file_index for file_index, (old, new) in enumerate(zip(saved, current))
+               if file_map.lengths[file_index] > 0 and new and new[0] > 0
+               and (old != new or new[0] != file_map.lengths[file_index])]
+    # Pieces on a missing file cannot be there, whatever the bitfield says
+    lost = set(pieces_of_files(file_map, torrent.piece_length, missing))
+    recheck = [piece_index for piece_index in pieces_of_files(file_map, torrent.piece_length, changed)
+               if piece_index not in lost]
+    suspect = lost.union(recheck)
+    trusted = Bitfield(torrent.num_pieces)
+    for piece_index in have.indices():
+        if piece_index not in suspect:
+            trusted.add(piece_index)
+    if not recheck:
+        return trusted
+
+    own_verifier = verifier is None
+    if own_verifier:
+        verifier = PieceVerifier()
+    try:
+        valid = await rehash(storage, torrent, recheck, verifier)
+    finally:
+        if own_verifier:
+            verifier.shutdown(wait=False)
+    for piece_index in valid:
+        trusted.add(piece_index)
+    print(f"{torrent.name}: {len(changed)} changed files, {len(valid)}/{len(recheck)} pieces valid, "
+          f"{trusted.count}/{torrent.num_pieces} pieces on disk")
+    return trusted
+
+
+class Checkpointer:
+    """
+    Saves the fast-resume data of a torrent every `interval` seconds.
+
+    A checkpoint copies the bitfield first and flushes the storage afterwards,
+    so every piece in the saved bitfield is on disk before the file states are
+    taken. A piece written after that changes the file's mtime, the next start
+    rehashes that file instead of trusting stale data.
+
+    Parameters:
+        path (str): resume file
+        torrent (torrent_file.Torrent): metadata
+        storage (storage.Storage): output files
+        have (piece_picker.Bitfield): verified pieces, updated while downloading
+        interval (float): seconds between checkpoints
+    """
+
+    def __init__(self, path, torrent, storage, have, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.torrent = torrent
+        self.storage = storage
+        self.have = have
+        self.interval = interval
+        self.saved_count = None     # pieces in the last checkpoint
+
+    def save(self, have):
+        self.storage.flush()
+        data = encode_resume(self.torrent.info_hash, have, file_states(self.storage.file_map))
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_atomic(self.path, data)
+        self.saved_count = have.count
+
+    async def checkpoint(self):
+        """Saves unless nothing was verified since the last checkpoint"""
+        if self.have.count != self.saved_count:
+            have = Bitfield(self.have.length, bytearray(self.have.bits))
+            await asyncio.to_thread(self.save, have)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.checkpoint()
+            except OSError as e:
+                print(f"Checkpoint {self.path} failed: {e!r}")
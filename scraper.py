@@ -0,0 +1,113 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import tracker
+import udp_tracker
+from announcer import announce_tiers
+
+# Defaults
+SCRAPE_TTL = 1800.0         # seconds a scrape result stays valid
+SCRAPE_TIMEOUT = 30.0       # HTTP only, UDP requests are bounded by max_retries
+
+
+class Scraper:
+    """
+    Seeder/leecher counts for many torrents, with a TTL cache.
+
+    All info hashes of one tracker are scraped together (74 per UDP packet,
+    several per HTTP request) and every tracker is scraped in parallel, so a
+    scrape round over a whole library costs a handful of requests. Results
+    younger than `ttl` are answered from the cache.
+
+    Parameters:
+        udp_client (udp_tracker.UdpTrackerClient): shared UDP client, a private one is created if None
+        http_client (tracker.HttpTrackerClient): shared HTTP client, a private one is created if None
+        ttl (float): cache lifetime in seconds
+        max_retries (int): UDP retransmissions per scrape, a round waits for its slowest tracker
+    """
+
+    def __init__(self, udp_client=None, http_client=None, ttl=SCRAPE_TTL, max_retries=udp_tracker.QUICK_MAX_RETRIES):
+        self.udp_client = udp_client if udp_client is not None else udp_tracker.UdpTrackerClient()
+        self.http_client = http_client if http_client is not None else tracker.HttpTrackerClient()
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.cache = {}         # (url, info_hash) -> (expires_at, stats)
+
+    def cached(self, url, info_hash, now=None):
+        """
+        Returns:
+            dictionary: {seeders, completed, leechers}, or None if unknown or expired
+        """
+        entry = self.cache.get((url, info_hash))
+        if entry is None:
+            return None
+        if entry[0] <= (time.monotonic() if now is None else now):
+            del self.cache[(url, info_hash)]
+            return None
+        return entry[1]
+
+    async def scrape_tracker(self, url, info_hashes):
+        if url.startswith('udp://'):
+            parts = urlsplit(url)
+            return await self.udp_client.scrape(parts.hostname, parts.port, info_hashes, self.max_retries)
+        if url.startswith(('http://', 'https://')):
+            return await asyncio.to_thread(self.http_client.scrape, url, info_hashes)
+        raise ValueError(f"Unsupported tracker protocol: {url}")
+
+    async def scrape(self, url, info_hashes):
+        """
+        Scrapes the info hashes that are not cached anymore.
+
+        Returns:
+            dictionary: info_hash -> {seeders, completed, leechers}, missing if the tracker does not know it
+        """
+        now = time.monotonic()
+        result = {}
+        stale = []
+        for info_hash in dict.fromkeys(info_hashes):
+            stats = self.cached(url, info_hash, now)
+            if stats is None:
+                stale.append(info_hash)
+            else:
+                result[info_hash] = stats
+        if stale:
+            if url.startswith('udp://'):
+                # Retransmitted by the UDP client, at most max_retries times
+                fresh = await self.scrape_tracker(url, stale)
+            else:
+                fresh = await asyncio.wait_for(self.scrape_tracker(url, stale), SCRAPE_TIMEOUT)
+            expires_at = time.monotonic() + self.ttl
+            for info_hash, stats in fresh.items():
+                self.cache[(url, info_hash)] = (expires_at, stats)
+            result.update(fresh)
+        return result
+
+    async def scrape_torrents(self, torrents):
+        """
+        One scrape round over many torrents: every tracker gets one batched
+        scrape for all torrents that use it.
+
+        Parameters:
+            torrents (list): torrent_file.Torrent objects
+
+        Returns:
+            dictionary: info_hash -> stats of the tracker that reports the most seeders
+        """
+        by_tracker = {}         # url -> [info_hash]
+        for torrent in torrents:
+            for tier in announce_tiers(torrent):
+                for url in tier:
+                    by_tracker.setdefault(url, []).append(torrent.info_hash)
+        urls = list(by_tracker)
+        responses = await asyncio.gather(*(self.scrape(url, by_tracker[url]) for url in urls),
+                                         return_exceptions=True)
+        best = {}
+        for url, response in zip(urls, responses):
+            if isinstance(response, Exception):
+                print(f"Scrape of {url} failed: {response!r}")
+                continue
+            for info_hash, stats in response.items():
+                if info_hash not in best or stats['seeders'] > best[info_hash]['seeders']:
+                    best[info_hash] = stats
+        return best
@@ -0,0 +1,342 @@
+import asyncio
+import socket
+import struct
+import time
+from collections import OrderedDict, deque
+
+import peer_protocol
+from choker import DEFAULT_UPLOAD_SLOTS, Choker
+from piece_picker import Bitfield
+from pipeline import RateMeter
+from udp_tracker import DEFAULT_PORT
+
+# Defaults
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_UPLOAD_PEERS = 50
+MAX_REQUEST_LENGTH = 128 * 1024     # larger requests are a protocol violation
+HANDSHAKE_TIMEOUT = 10.0
+MESSAGE_TIMEOUT = 120.0
+RECV_SIZE = 64 * 1024
+UPLOAD_BATCH = 8                    # blocks queued before the socket is drained
+UPLOAD_RATE_WINDOW = 20.0           # seconds of upload history the choker ranks by
+
+
+class PieceCache:
+    """
+    Size-bounded LRU of whole pieces read from storage.
+
+    Peers request a piece block by block and popular pieces are requested by
+    many peers, so every piece is read from disk once and then served from
+    memory. Concurrent misses for the same piece share one read.
+
+    Parameters:
+        storage (storage.Storage): verified pieces
+        torrent (torrent_file.Torrent): metadata
+        max_bytes (int): cache size
+    """
+
+    def __init__(self, storage, torrent, max_bytes=DEFAULT_CACHE_BYTES):
+        self.storage = storage
+        self.torrent = torrent
+        self.max_bytes = max_bytes
+        self.pieces = OrderedDict()     # piece_index -> bytes
+        self.size = 0
+        self.loading = {}               # piece_index -> Future
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, piece_index):
+        data = self.pieces.get(piece_index)
+        if data is not None:
+            self.pieces.move_to_end(piece_index)
+            self.hits += 1
+            return data
+        future = self.loading.get(piece_index)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.ensure_future(asyncio.to_thread(
+            self.storage.read_piece, piece_index, self.torrent.piece_size(piece_index)))
+        self.loading[piece_index] = future
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            self.loading.pop(piece_index, None)
+        self.put(piece_index, data)
+        return data
+
+    def put(self, piece_index, data):
+        if len(data) > self.max_bytes or piece_index in self.pieces:
+            return
+        while self.size + len(data) > self.max_bytes:
+            _, old = self.pieces.popitem(last=False)
+            self.size -= len(old)
+        self.pieces[piece_index] = data
+        self.size += len(data)
+
+
+class SharedTorrent:
+    """
+    A torrent we upload: metadata, storage, the verified pieces and the read cache.
+    """
+
+    def __init__(self, torrent, storage, have, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.torrent = torrent
+        self.storage = storage
+        self.have = have
+        self.cache = PieceCache(storage, torrent, cache_bytes)
+        self.connections = set()
+        self.uploaded = 0
+
+
+class UploadConnection:
+    """
+    Incoming peer connection: serves its requests from the piece cache.
+    """
+
+    def __init__(self, seeder, shared, reader, writer, peer_info):
+        self.seeder = seeder
+        self.shared = shared
+        self.reader = reader
+        self.writer = writer
+        self.peer_id = peer_info['peer_id']
+        self.peer_ip = writer.get_extra_info('peername', ('', 0))[0]
+        self.connected_at = time.monotonic()
+        self.meter = RateMeter(UPLOAD_RATE_WINDOW)
+        self.am_choking = True
+        self.peer_interested = False
+        self.have = Bitfield(shared.torrent.num_pieces)
+        self.requests = deque()         # (piece_index, begin, length), in order of arrival
+        self.decoder = peer_protocol.MessageDecoder()
+        self.outgoing = peer_protocol.OutgoingQueue()
+        self.uploaded = 0
+        self.task = asyncio.current_task()  # handle() of this connection
+        bandwidth = seeder.bandwidth
+        self.limiter = bandwidth.peer(shared.torrent.info_hash) if bandwidth is not None else None
+
+    def __repr__(self):
+        peer = self.writer.get_extra_info('peername')
+        return f"{peer[0]}:{peer[1]}" if peer else "unknown peer"
+
+    def choke(self):
+        if not self.am_choking:
+            self.am_choking = True
+            # Requests are discarded on choke, the peer asks again after unchoke
+            self.requests.clear()
+            self.outgoing.choke()
+            self.outgoing.flush_to(self.writer)
+
+    def unchoke(self):
+        if self.am_choking:
+            self.am_choking = False
+            self.outgoing.unchoke()
+            self.outgoing.flush_to(self.writer)
+
+    def upload_rate(self):
+        return self.meter.rate()
+
+    def send_have(self, piece_index):
+        self.outgoing.have(piece_index)
+        self.outgoing.flush_to(self.writer)
+
+    async def run(self):
+        self.outgoing.message(peer_protocol.MSG_BITFIELD, self.shared.have.to_bytes())
+        await self.flush()
+        while True:
+            data = await asyncio.wait_for(self.reader.read(RECV_SIZE), MESSAGE_TIMEOUT)
+            if not data:
+                return
+            for message_id, payload in self.decoder.feed(data):
+                self.handle_message(message_id, payload)
+            await self.serve_requests()
+            await self.flush()
+
+    async def flush(self):
+        self.outgoing.flush_to(self.writer)
+        await self.writer.drain()
+
+    def handle_message(self, message_id, payload):
+        if message_id == peer_protocol.MSG_INTERESTED:
+            self.peer_interested = True
+            self.seeder.peer_interested(self)
+        elif message_id == peer_protocol.MSG_NOT_INTERESTED:
+            self.peer_interested = False
+        elif message_id == peer_protocol.MSG_REQUEST:
+            request = peer_protocol.parse_request(payload)
+            self.check_request(*request)
+            if not self.am_choking:
+                self.requests.append(request)
+        elif message_id == peer_protocol.MSG_CANCEL:
+            request = peer_protocol.parse_request(payload)
+            try:
+                self.requests.remove(request)
+            except ValueError:
+                pass
+        elif message_id == peer_protocol.MSG_HAVE:
+            self.have.add(struct.unpack('>I', payload)[0])
+        elif message_id == peer_protocol.MSG_BITFIELD:
+            self.have = Bitfield.from_payload(payload, self.shared.torrent.num_pieces)
+
+    def check_request(self, piece_index, begin, length):
+        torrent = self.shared.torrent
+        if not 0 <= piece_index < torrent.num_pieces:
+            raise ValueError(f"Request for piece {piece_index} out of range")
+        if length <= 0 or length > MAX_REQUEST_LENGTH or begin + length > torrent.piece_size(piece_index):
+            raise ValueError(f"Invalid request {piece_index}/{begin}+{length}")
+
+    async def serve_requests(self):
+        queued = 0
+        while self.requests and not self.am_choking:
+            piece_index, begin, length = self.requests.popleft()
+            if piece_index not in self.shared.have:
+                continue
+            data = await self.shared.cache.get(piece_index)
+            if self.limiter is not None:
+                # Message header (13 bytes) counts too
+                await self.limiter.upload(13 + length)
+                if self.am_choking:
+                    return
+            self.outgoing.piece(piece_index, begin, memoryview(data)[begin:begin + length])
+            self.uploaded += length
+            self.meter.add(length)
+            self.shared.uploaded += length
+            queued += 1
+            if queued >= UPLOAD_BATCH:
+                await self.flush()
+                queued = 0
+
+
+class Seeder:
+    """
+    Listens for incoming peers and uploads verified pieces to them.
+
+    The handshake selects the torrent by its info hash, then the peer gets our
+    bitfield and have messages for every piece verified later on. A Choker
+    decides which interested peers are unchoked, requests are answered from a
+    PieceCache per torrent.
+
+    Parameters:
+        peer_id (bytes): 20-byte Peer-ID
+        port (int): listen port, the one announced to the trackers
+        max_peers (int): cap on incoming connections
+        download_rate (callable): download_rate(ip) -> bytes/s we receive from that peer,
+            ranks peers while downloading (tit-for-tat); None ranks by upload rate
+        upload_slots (int): unchoked peers, see Choker
+        bandwidth (bandwidth.BandwidthScheduler): upload caps, None = unlimited
+        limits (session.SessionLimits): incoming connections count against its connection budget
+    """
+
+    def __init__(self, peer_id, port=DEFAULT_PORT, max_peers=DEFAULT_MAX_UPLOAD_PEERS, download_rate=None,
+                 upload_slots=DEFAULT_UPLOAD_SLOTS, bandwidth=None, limits=None):
+        self.peer_id = peer_id
+        self.port = port
+        self.max_peers = max_peers
+        self.download_rate = download_rate
+        self.bandwidth = bandwidth
+        self.limits = limits
+        self.torrents = {}      # info_hash -> SharedTorrent
+        self.connections = set()
+        self.choker = Choker(self.reciprocation_rate, upload_slots)
+        self.choker_task = None
+        self.server = None
+
+    def add_torrent(self, torrent, storage, have, cache_bytes=DEFAULT_CACHE_BYTES):
+        """
+        Parameters:
+            have (piece_picker.Bitfield): verified pieces, updated via piece_completed
+        """
+        shared = SharedTorrent(torrent, storage, have, cache_bytes)
+        self.torrents[torrent.info_hash] = shared
+        return shared
+
+    async def remove_torrent(self, info_hash):
+        """Stops serving a torrent, returns once all its connections are closed"""
+        shared = self.torrents.pop(info_hash, None)
+        if shared is None:
+            return
+        tasks = []
+        for conn in list(shared.connections):
+            conn.writer.close()
+            if conn.limiter is not None:
+                # A connection waiting for upload tokens would not notice the close
+                conn.limiter.close(ConnectionAbortedError("Torrent removed"))
+            if conn.task is not None and conn.task is not asyncio.current_task():
+                tasks.append(conn.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def piece_completed(self, info_hash, piece_index):
+        """A piece was verified: announce it to every peer of the torrent"""
+        shared = self.torrents.get(info_hash)
+        if shared is None or not shared.have.add(piece_index):
+            return
+        for conn in shared.connections:
+            conn.send_have(piece_index)
+
+    def peer_interested(self, conn):
+        self.choker.peer_interested(conn)
+
+    def reciprocation_rate(self, conn):
+        """
+        While downloading peers are ranked by what they give us, once the
+        torrent is complete by how fast they take our data.
+        """
+        if self.download_rate is None or conn.shared.have.is_complete():
+            return conn.upload_rate()
+        return self.download_rate(conn.peer_ip)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, port=self.port)
+        # With port 0 every address family gets its own port, trackers see the IPv4 one
+        sockets = sorted(self.server.sockets, key=lambda sock: sock.family != socket.AF_INET)
+        self.port = sockets[0].getsockname()[1]
+        self.choker_task = asyncio.create_task(self.choker.run())
+        return self.port
+
+    async def close(self):
+        if self.choker_task is not None:
+            self.choker_task.cancel()
+            self.choker_task = None
+        if self.server is not None:
+            self.server.close()
+            for conn in list(self.connections):
+                conn.writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        conn = None
+        holds_slot = False
+        try:
+            if len(self.connections) >= self.max_peers:
+                return
+            if self.limits is not None:
+                if not self.limits.connections.acquire():
+                    return
+                holds_slot = True
+            handshake = await asyncio.wait_for(reader.readexactly(peer_protocol.HANDSHAKE_LENGTH),
+                                               HANDSHAKE_TIMEOUT)
+            # info_hash sits at bytes 28..48
+            shared = self.torrents.get(bytes(handshake[28:48]))
+            if shared is None:
+                return
+            peer_info = peer_protocol.parse_handshake(handshake, shared.torrent.info_hash)
+            writer.write(peer_protocol.build_handshake(shared.torrent.info_hash, self.peer_id))
+            conn = UploadConnection(self, shared, reader, writer, peer_info)
+            self.connections.add(conn)
+            shared.connections.add(conn)
+            self.choker.add(conn)
+            await conn.run()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                AssertionError, struct.error, ValueError, IndexError) as e:
+            print(f"Upload peer {conn or writer.get_extra_info('peername')} failed: {e!r}")
+        finally:
+            if holds_slot:
+                self.limits.connections.release()
+            if conn is not None:
+                if conn.limiter is not None:
+                    conn.limiter.close()
+                self.choker.remove(conn)
+                self.connections.discard(conn)
+                conn.shared.connections.discard(conn)
+            writer.close()
@@ -0,0 +1,362 @@
+import asyncio
+
+import announcer
+import resume
+import storage
+import tracker
+import udp_tracker
+from bandwidth import BandwidthScheduler
+from peer_backoff import PeerBackoff
+from piece_picker import Bitfield
+from seeder import DEFAULT_MAX_UPLOAD_PEERS, Seeder
+from swarm import Swarm
+from verifier import PieceVerifier
+
+# Defaults
+DEFAULT_MAX_CONNECTIONS = 500       # peer connections of all torrents, incoming ones included
+DEFAULT_MAX_HALF_OPEN = 50
+DEFAULT_MAX_BUFFER_BYTES = 256 * 1024 * 1024    # buffers of pieces being downloaded
+DEFAULT_MAX_OPEN_FILES = 512
+MIN_CONNECTIONS = 2                 # every downloading torrent may dial at least this many peers
+DOWNLOAD_FILE_WEIGHT = 4            # downloading torrents get 4x the file handles of seeding ones
+REBALANCE_INTERVAL = 5.0
+STOP_TIMEOUT = 10.0                 # time for the `stopped` announces of a removed torrent
+
+
+def fair_shares(total, demands, minimum=1):
+    """
+    Max-min fair split of `total`: whoever needs less than an equal share gets
+    what it needs, the rest is split evenly among the others.
+
+    Parameters:
+        demands (dictionary): key -> units wanted
+
+    Returns:
+        dictionary: key -> share, at least `minimum`
+    """
+    shares = {}
+    pending = sorted(demands.items(), key=lambda item: item[1])
+    remaining = total
+    while pending:
+        equal = remaining // len(pending)
+        key, demand = pending[0]
+        if demand >= equal:
+            break
+        shares[key] = max(minimum, demand)
+        remaining -= shares[key]
+        pending.pop(0)
+    for key, _ in pending:
+        shares[key] = max(minimum, remaining // len(pending))
+    return shares
+
+
+class Allowance:
+    """
+    A session-wide count (connections, half-open connects, buffer bytes) that
+    all torrents take from.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def available(self):
+        return self.limit - self.used
+
+    def acquire(self, amount=1):
+        """
+        Returns:
+            bool: False if `amount` does not fit anymore; the first one always fits,
+                  so a piece larger than the whole budget can still be downloaded
+        """
+        if self.used and self.used + amount > self.limit:
+            return False
+        self.used += amount
+        return True
+
+    def release(self, amount=1):
+        self.used -= amount
+
+
+class SessionLimits:
+    """Budgets shared by all swarms and the seeder of a session"""
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_half_open=DEFAULT_MAX_HALF_OPEN,
+                 max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES):
+        self.connections = Allowance(max_connections)
+        self.half_open = Allowance(max_half_open)
+        self.buffers = Allowance(max_buffer_bytes)
+
+
+class SessionTorrent:
+    """
+    One torrent of a session: its storage, swarm, announce schedule and resume checkpoints.
+    """
+
+    def __init__(self, session, torrent, output_path, storage, have):
+        self.session = session
+        self.torrent = torrent
+        self.output_path = output_path
+        self.storage = storage
+        self.have = have
+        self.downloaded = 0
+        self.left = torrent.total_size - sum(torrent.piece_size(index) for index in have.indices())
+        self.shared = session.seeder.add_torrent(torrent, storage, have)
+        self.swarm = Swarm(torrent, torrent.info_hash, session.peer_id, self.on_piece,
+                           backoff=session.backoff, bandwidth=session.bandwidth, limits=session.limits,
+                           drain=storage.drain, verifier=session.verifier)
+        for index in have.indices():
+            self.swarm.picker.complete(index)
+        self.announcer = announcer.Announcer(torrent, session.peer_id, session.seeder.port,
+                                             session.udp_client, session.http_client)
+        self.scheduler = announcer.AnnounceScheduler(self.announcer, self.progress, self.swarm.add_peers)
+        self.checkpointer = None
+        if session.resume_dir is not None:
+            self.checkpointer = resume.Checkpointer(resume.resume_path(session.resume_dir, self.info_hash),
+                                                    torrent, storage, have, session.checkpoint_interval)
+        self.task = None
+        self.scheduler_task = None
+        self.checkpoint_task = None
+
+    @property
+    def info_hash(self):
+        return self.torrent.info_hash
+
+    def __repr__(self):
+        return self.torrent.name
+
+    def is_complete(self):
+        return self.swarm.is_complete()
+
+    def on_piece(self, piece_index, piece_data):
+        self.storage.write_piece(piece_index, piece_data)
+        self.downloaded += len(piece_data)
+        self.left -= len(piece_data)
+        self.session.seeder.piece_completed(self.info_hash, piece_index)
+
+    def progress(self):
+        # Peers we are connected to or about to dial, the tracker's last list may be stale
+        return self.shared.uploaded, self.downloaded, self.left, self.connection_demand()
+
+    def connection_demand(self):
+        """Connections the swarm could use right now: open, being dialed and queued"""
+        return len(self.swarm.active_peers) + len(self.swarm.candidates)
+
+    def start(self):
+        self.scheduler_task = asyncio.create_task(self.scheduler.run())
+        if self.checkpointer is not None:
+            self.checkpoint_task = asyncio.create_task(self.checkpointer.run())
+        self.task = asyncio.create_task(self.download())
+
+    async def download(self):
+        """Downloads until complete, seeding goes on until the torrent is removed"""
+        if self.is_complete():
+            return
+        await self.swarm.run([], wait_for_peers=True)
+        await asyncio.to_thread(self.storage.flush)
+        if self.checkpointer is not None:
+            await self.checkpointer.checkpoint()
+        self.scheduler.completed()
+        print(f"{self}: download complete, seeding")
+        self.session.rebalance()
+
+    async def close(self):
+        """Closes the peers, sends `stopped` to the trackers, saves the resume data and the files"""
+        self.task.cancel()
+        result, = await asyncio.gather(self.task, return_exceptions=True)
+        if isinstance(result, Exception):
+            print(f"{self}: download failed: {result!r}")
+        self.scheduler.stop()
+        try:
+            await asyncio.wait_for(self.scheduler_task, STOP_TIMEOUT)
+        except Exception as e:
+            print(f"{self}: stopped announce failed: {e!r}")
+        await self.session.seeder.remove_torrent(self.info_hash)
+        if self.checkpoint_task is not None:
+            self.checkpoint_task.cancel()
+            await asyncio.gather(self.checkpoint_task, return_exceptions=True)
+            try:
+                await self.checkpointer.checkpoint()
+            except OSError as e:
+                print(f"{self}: last checkpoint failed: {e!r}")
+        if self.session.bandwidth is not None:
+            # After the swarm and the seeder connections are gone, none of them waits for tokens
+            self.session.bandwidth.remove_torrent(self.info_hash)
+        await asyncio.to_thread(self.storage.close)
+
+
+class Session:
+    """
+    Runs many torrents in one process and one event loop.
+
+    All torrents share the tracker clients, the listening Seeder, the peer
+    backoff record and the bandwidth caps. Peer connections (incoming ones
+    included), half-open connects and piece buffers are capped for the whole
+    session through SessionLimits; file handles are split among the torrents'
+    storages. Torrents can be added and removed while the session runs, and
+    every REBALANCE_INTERVAL the connection slots are split max-min fairly by
+    what each downloading swarm can use, so idle and seeding torrents leave
+    their share to the active ones.
+
+    Parameters:
+        peer_id (bytes): 20-byte Peer-ID, a new one if None
+        port (int): listen port of the Seeder
+        max_connections (int): peer connections of all torrents
+        max_half_open (int): connection attempts in flight of all torrents
+        max_buffer_bytes (int): memory for pieces being downloaded
+        max_open_files (int): file descriptors of all storages
+        max_upload_peers (int): cap on incoming connections
+        download_limit (float): global download cap in bytes/s, None = unlimited
+        upload_limit (float): global upload cap in bytes/s, None = unlimited
+        peer_download_limit (float): download cap of every peer in bytes/s, None = unlimited
+        peer_upload_limit (float): upload cap of every peer in bytes/s, None = unlimited
+        resume_dir (str): directory for fast-resume data, None = no resume
+        checkpoint_interval (float): seconds between two saves of the resume data
+    """
+
+    def __init__(self, peer_id=None, port=udp_tracker.DEFAULT_PORT, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_half_open=DEFAULT_MAX_HALF_OPEN, max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES, max_upload_peers=DEFAULT_MAX_UPLOAD_PEERS,
+                 download_limit=None, upload_limit=None, resume_dir=None,
+                 checkpoint_interval=resume.DEFAULT_CHECKPOINT_INTERVAL, peer_download_limit=None,
+                 peer_upload_limit=None):
+        self.peer_id = peer_id if peer_id is not None else udp_tracker.generate_peer_id()
+        self.limits = SessionLimits(max_connections, max_half_open, max_buffer_bytes)
+        self.max_open_files = max_open_files
+        self.resume_dir = resume_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.verifier = PieceVerifier()     # rehashes changed files on startup
+        self.udp_client = udp_tracker.UdpTrackerClient()
+        self.http_client = tracker.HttpTrackerClient()
+        self.backoff = PeerBackoff()
+        self.bandwidth = None
+        if download_limit or upload_limit or peer_download_limit or peer_upload_limit:
+            self.bandwidth = BandwidthScheduler(download_limit, upload_limit, peer_download_rate=peer_download_limit,
+                                                peer_upload_rate=peer_upload_limit)
+        self.seeder = Seeder(self.peer_id, port, max_upload_peers, download_rate=self.download_rate,
+                             bandwidth=self.bandwidth, limits=self.limits)
+        self.torrents = {}      # info_hash -> SessionTorrent
+        self.rebalance_task = None
+
+    async def start(self):
+        await self.udp_client.start()
+        try:
+            await self.seeder.start()
+        except OSError as e:
+            print(f"Listen on port {self.seeder.port} failed, download only: {e}")
+        self.rebalance_task = asyncio.create_task(self.rebalance_loop())
+
+    async def close(self):
+        if self.rebalance_task is not None:
+            self.rebalance_task.cancel()
+            self.rebalance_task = None
+        await asyncio.gather(*(self.remove_torrent(info_hash) for info_hash in list(self.torrents)))
+        await self.seeder.close()
+        self.udp_client.close()
+        self.http_client.close()
+        self.verifier.shutdown(wait=False)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def add_torrent(self, torrent, output_path, have=None, download_limit=None, upload_limit=None):
+        """
+        Starts downloading (or seeding) a torrent.
+
+        Parameters:
+            torrent (torrent_file.Torrent): metadata
+            output_path (str): file for single-file torrents, directory for multi-file torrents
+            have (piece_picker.Bitfield): pieces already verified on disk, None = from the
+                resume data (or none without resume_dir)
+            download_limit (float): download cap of this torrent in bytes/s, None = unlimited
+            upload_limit (float): upload cap of this torrent in bytes/s, None = unlimited
+
+        Returns:
+            SessionTorrent
+        """
+        if torrent.info_hash in self.torrents:
+            return self.torrents[torrent.info_hash]
+        files = storage.files_from_torrent(torrent, output_path)
+        output = await asyncio.to_thread(storage.Storage, files, torrent.piece_length)
+        if have is None and self.resume_dir is not None:
+            have = await resume.restore(resume.resume_path(self.resume_dir, torrent.info_hash),
+                                        torrent, output, self.verifier)
+        if download_limit or upload_limit:
+            self.set_torrent_limit(torrent.info_hash, download_limit, upload_limit)
+        entry = SessionTorrent(self, torrent, output_path, output,
+                               have if have is not None else Bitfield(torrent.num_pieces))
+        self.torrents[torrent.info_hash] = entry
+        entry.start()
+        self.rebalance()
+        return entry
+
+    async def remove_torrent(self, info_hash):
+        """Stops a torrent: its peers are closed, trackers get `stopped`, the files are flushed"""
+        entry = self.torrents.pop(info_hash, None)
+        if entry is None:
+            return
+        await entry.close()
+        self.rebalance()
+
+    def set_torrent_limit(self, info_hash, download_limit=None, upload_limit=None):
+        """Caps one torrent, its peers that connect from now on share the limits"""
+        if self.bandwidth is None:
+            # No caps so far: connections of other torrents stay unlimited
+            self.bandwidth = BandwidthScheduler()
+            self.seeder.bandwidth = self.bandwidth
+        self.bandwidth.add_torrent(info_hash, download_limit, upload_limit)
+
+    def download_rate(self, peer_ip):
+        """Rate we receive from a peer over all torrents, ranks it in the Seeder's choker"""
+        return sum(entry.swarm.download_rate(peer_ip) for entry in self.torrents.values())
+
+    def rebalance(self):
+        """
+        Splits connection slots among the downloading swarms by what they can
+        use, and file handles among all storages, downloading ones weighted
+        DOWNLOAD_FILE_WEIGHT.
+        """
+        limits = self.limits
+        downloading = [entry for entry in self.torrents.values() if not entry.is_complete()]
+        outgoing = max(0, limits.connections.limit - len(self.seeder.connections))
+        shares = fair_shares(outgoing, {entry: entry.connection_demand() for entry in downloading},
+                             MIN_CONNECTIONS)
+        for entry, share in shares.items():
+            entry.swarm.max_connections = share
+            entry.swarm.max_half_open = max(1, share * limits.half_open.limit // limits.connections.limit)
+            entry.swarm.wakeup()
+
+        weights = {entry: DOWNLOAD_FILE_WEIGHT if not entry.is_complete() else 1
+                   for entry in self.torrents.values()}
+        total = sum(weights.values())
+        for entry, weight in weights.items():
+            entry.storage.files.max_open = max(1, self.max_open_files * weight // total)
+
+    async def rebalance_loop(self):
+        while True:
+            await asyncio.sleep(REBALANCE_INTERVAL)
+            self.rebalance()
+
+    async def wait_complete(self):
+        """Waits until every torrent of the session is downloaded"""
+        await asyncio.gather(*(entry.swarm.done.wait() for entry in list(self.torrents.values())
+                               if not entry.is_complete()))
+
+    def stats(self):
+        """
+        Returns:
+            dictionary: per torrent name the pieces done, connections and bytes up/down
+        """
+        return {
+            entry.torrent.name: {
+                'pieces': f"{entry.swarm.picker.num_done}/{entry.torrent.num_pieces}",
+                'connections': len(entry.swarm.connections),
+                'downloaded': entry.downloaded,
+                'uploaded': entry.shared.uploaded,
+            }
+            for entry in self.torrents.values()
+        }
@@ -0,0 +1,361 @@
+import asyncio
+import os
+import queue
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Defaults
+DEFAULT_QUEUE_SIZE = 64         # pieces waiting for the writer thread
+DEFAULT_MAX_OPEN_FILES = 128
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+IOV_MAX = 1024
+
+
+class StorageError(Exception):
+    """Writing to the output files failed; not a peer's fault, ends the download"""
+
+
+def preallocate(fd, size):
+    """
+    Reserves `size` bytes for the file. Uses fallocate where the platform and
+    file system support it, otherwise extends the file sparsely.
+    """
+    if os.fstat(fd).st_size >= size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def pwrite_all(fd, data, offset):
+    """os.pwrite until everything is written (pwrite may write less)"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def pwritev_all(fd, buffers, offset):
+    """os.pwritev for a list of buffers, falls back to pwrite"""
+    if len(buffers) == 1 or not hasattr(os, 'pwritev'):
+        for buf in buffers:
+            pwrite_all(fd, buf, offset)
+            offset += len(buf)
+        return
+    total = sum(len(buf) for buf in buffers)
+    written = os.pwritev(fd, buffers, offset)
+    if written < total:
+        # Short vectored write: finish the rest with plain pwrite
+        pwrite_all(fd, b''.join(buffers)[written:], offset + written)
+
+
+def pread_exact(fd, length, offset):
+    data = os.pread(fd, length, offset)
+    if len(data) != length:
+        raise EOFError(f"Short read at offset {offset}: {len(data)} of {length} bytes")
+    return data
+
+
+def path_component(name):
+    """
+    A single file name from the torrent's file list, rejects path traversal.
+    """
+    if name in ('', '.', '..') or '/' in name or os.sep in name:
+        raise ValueError(f"Invalid path component in torrent: {name!r}")
+    return name
+
+
+def files_from_torrent(torrent, output_path):
+    """
+    Parameters:
+        torrent (torrent_file.Torrent): metadata
+        output_path (str): file for single-file torrents, directory for multi-file torrents
+
+    Returns:
+        list: [(path, length)] in torrent order
+    """
+    if torrent.files is None:
+        return [(output_path, torrent.total_size)]
+    return [(os.path.join(output_path, *(path_component(part) for part in parts)), length)
+            for parts, length in torrent.files]
+
+
+class FileMap:
+    """
+    Maps offsets in the concatenated torrent content to (file, offset) pairs.
+
+    Keeps the start offsets of all non-empty files in a sorted list, so every
+    lookup is a bisect instead of a scan over the file list.
+
+    Parameters:
+        files (list): [(path, length)]
+    """
+
+    def __init__(self, files):
+        self.paths = [path for path, _ in files]
+        self.lengths = [length for _, length in files]
+        self.starts = []        # start offsets of the non-empty files
+        self.indices = []       # file index of every entry in starts
+        offset = 0
+        for file_index, length in enumerate(self.lengths):
+            if length > 0:
+                self.starts.append(offset)
+                self.indices.append(file_index)
+            offset += length
+        self.total_size = offset
+
+    def segments(self, offset, length):
+        """
+        Splits a range of the torrent content into per-file pieces.
+
+        Returns:
+            list: [(file_index, file_offset, length)]
+        """
+        if offset < 0 or offset + length > self.total_size:
+            raise ValueError(f"Range {offset}+{length} outside of torrent ({self.total_size} bytes)")
+        result = []
+        pos = bisect_right(self.starts, offset) - 1
+        while length > 0:
+            file_index = self.indices[pos]
+            file_offset = offset - self.starts[pos]
+            seg_length = min(length, self.lengths[file_index] - file_offset)
+            result.append((file_index, file_offset, seg_length))
+            offset += seg_length
+            length -= seg_length
+            pos += 1
+        return result
+
+
+class FilePool:
+    """
+    Bounded LRU of open file descriptors.
+
+    Files are created and preallocated on first use. Callers hold `lock`
+    while using a descriptor, so it cannot be closed by an eviction meanwhile.
+    """
+
+    def __init__(self, file_map, max_open=DEFAULT_MAX_OPEN_FILES):
+        self.file_map = file_map
+        self.max_open = max_open
+        self.open_files = OrderedDict()     # file_index -> fd
+        self.lock = threading.RLock()
+
+    def get(self, file_index):
+        fd = self.open_files.get(file_index)
+        if fd is not None:
+            self.open_files.move_to_end(file_index)
+            return fd
+        while len(self.open_files) >= self.max_open:
+            _, old_fd = self.open_files.popitem(last=False)
+            os.close(old_fd)
+        path = self.file_map.paths[file_index]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            preallocate(fd, self.file_map.lengths[file_index])
+        except OSError:
+            os.close(fd)
+            raise
+        self.open_files[file_index] = fd
+        return fd
+
+    def close_all(self):
+        with self.lock:
+            while self.open_files:
+                _, fd = self.open_files.popitem()
+                os.close(fd)
+
+
+def take(views, length):
+    """Removes the first `length` bytes from a list of memoryviews"""
+    taken = []
+    while length > 0:
+        view = views[0]
+        if len(view) <= length:
+            taken.append(views.pop(0))
+            length -= len(view)
+        else:
+            taken.append(view[:length])
+            views[0] = view[length:]
+            length = 0
+    return taken
+
+
+class Storage:
+    """
+    Output files of a torrent, single- or multi-file.
+
+    Offsets are resolved to files with a FileMap and descriptors stay open in
+    a bounded FilePool. Verified pieces are handed to a writer thread
+    (write-behind) that merges adjacent pieces into positional writes, so the
+    network loop never waits for the disk. write_piece never blocks; callers
+    apply backpressure with drain() (async) or wait_for_space() once
+    queue_size pieces are waiting.
+
+    Parameters:
+        files (list): [(path, length)], see files_from_torrent
+        piece_length (int): nominal piece length
+        queue_size (int): pieces waiting to be written before drain() waits
+        max_open_files (int): max. number of open file descriptors
+    """
+
+    def __init__(self, files, piece_length, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES):
+        self.file_map = FileMap(files)
+        self.total_size = self.file_map.total_size
+        self.piece_length = piece_length
+        self.files = FilePool(self.file_map, max_open_files)
+        self.create_empty_files()
+        self.pending = {}       # piece_index -> data, until written
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)    # notified whenever pieces were written
+        self.queue_size = queue_size
+        self.queue = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop, name="storage-writer", daemon=True)
+        self.writer.start()
+
+    def create_empty_files(self):
+        """Zero-length files never receive a write, create them up front"""
+        for path, length in zip(self.file_map.paths, self.file_map.lengths):
+            if length == 0:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                open(path, 'ab').close()
+
+    def write_piece(self, piece_index, piece_data):
+        """Queues a verified piece for writing, without blocking; errors surface in drain()"""
+        with self.lock:
+            self.pending[piece_index] = piece_data
+        self.queue.put(piece_index)
+
+    def wait_for_space(self):
+        """
+        Blocks while queue_size or more pieces wait for the writer.
+
+        Raises:
+            StorageError: the writer thread failed
+        """
+        with self.space:
+            while len(self.pending) >= self.queue_size and self.error is None and not self.closed:
+                self.space.wait()
+        if self.error is not None:
+            raise StorageError(f"Writing the output files failed: {self.error}") from self.error
+
+    async def drain(self):
+        """wait_for_space() for the event loop: waits on a worker thread only when the queue is full"""
+        if len(self.pending) >= self.queue_size:
+            await asyncio.to_thread(self.wait_for_space)
+        elif self.error is not None:
+            self.wait_for_space()
+
+    def read_piece(self, piece_index, length):
+        with self.lock:
+            data = self.pending.get(piece_index)
+        if data is not None:
+            return bytes(data)
+        return self.read(piece_index * self.piece_length, length)
+
+    def read(self, offset, length):
+        """Reads a range of the torrent content, across file boundaries"""
+        parts = []
+        with self.files.lock:
+            for file_index, file_offset, seg_length in self.file_map.segments(offset, length):
+                fd = self.files.get(file_index)
+                parts.append(pread_exact(fd, seg_length, file_offset))
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def write(self, offset, buffers):
+        """Writes buffers to a range of the torrent content, across file boundaries"""
+        views = [memoryview(buf) for buf in buffers]
+        length = sum(len(view) for view in views)
+        with self.files.lock:
+            for file_index, file_offset, seg_length in self.file_map.segments(offset, length):
+                fd = self.files.get(file_index)
+                pwritev_all(fd, take(views, seg_length), file_offset)
+
+    def _write_loop(self):
+        while True:
+            piece_index = self.queue.get()
+            if piece_index is None:
+                self.queue.task_done()
+                return
+            batch = [piece_index]
+            # Take whatever else is already waiting
+            while True:
+                try:
+                    piece_index = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if piece_index is None:
+                    self.queue.put(None)
+                    self.queue.task_done()
+                    break
+                batch.append(piece_index)
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                with self.space:
+                    self.error = e
+                    self.space.notify_all()
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write_batch(self, batch):
+        with self.lock:
+            pieces = sorted((index, self.pending[index]) for index in set(batch))
+        run = []
+        run_start = None
+        run_bytes = 0
+        for index, data in pieces:
+            offset = index * self.piece_length
+            if run and (offset != run_start + run_bytes or len(run) >= IOV_MAX
+                        or run_bytes >= MAX_BATCH_BYTES):
+                self.write(run_start, run)
+                run = []
+            if not run:
+                run_start = offset
+                run_bytes = 0
+            run.append(data)
+            run_bytes += len(data)
+        if run:
+            self.write(run_start, run)
+        with self.space:
+            for index, data in pieces:
+                if self.pending.get(index) is data:
+                    del self.pending[index]
+            self.space.notify_all()
+
+    def flush(self):
+        """Waits until all queued pieces are on disk"""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+        with self.space:
+            self.closed = True
+            self.space.notify_all()
+        self.queue.put(None)
+        self.writer.join()
+        self.files.close_all()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,651 @@
+import asyncio
+import struct
+import time
+from collections import deque
+
+import peer_protocol
+from peer_backoff import PeerBackoff
+from piece_picker import Bitfield, PiecePicker
+from pipeline import BLOCK_SIZE, RequestWindow
+from verifier import IncrementalPiece, PieceVerifier
+
+# Defaults
+DEFAULT_MAX_CONNECTIONS = 50
+DEFAULT_MAX_HALF_OPEN = 20
+CONNECT_TIMEOUT = 5.0
+MESSAGE_TIMEOUT = 120.0
+RECV_SIZE = 256 * 1024
+ENDGAME_MAX_REQUESTS = 4        # peers asked for the same block at once in endgame
+SNUB_TIMEOUT = 60.0             # no block for this long while unchoked with requests out = snubbed
+SNUB_CHECK_INTERVAL = 10.0
+
+PEER_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, AssertionError, struct.error, ValueError,
+               IndexError)
+
+
+class PieceDownload(IncrementalPiece):
+    """
+    Piece that is currently being downloaded, with the blocks not yet
+    requested and the connections that have a request for each block out.
+    """
+
+    def __init__(self, index, length, expected_hash, owner, verifier=None):
+        super().__init__(index, length, expected_hash, verifier)
+        self.owner = owner
+        self.pending = deque((begin, self.block_length(begin)) for begin in range(0, length, BLOCK_SIZE))
+        self.requesters = {}    # begin -> [PeerConnection], first one requested it first
+
+    def block_length(self, begin):
+        return min(BLOCK_SIZE, self.length - begin)
+
+    def has_block(self, begin):
+        return begin < self.hashed or begin in self.waiting
+
+
+class PeerConnection:
+    """
+    One peer of the swarm: handshake, message loop and its own piece assignment.
+    """
+
+    def __init__(self, swarm, peer_ip, peer_port):
+        self.swarm = swarm
+        self.peer_ip = peer_ip
+        self.peer_port = peer_port
+        self.reader = None
+        self.writer = None
+        self.peer_choking = True
+        self.snubbed = False
+        self.last_block_at = time.monotonic()
+        self.have = Bitfield(swarm.num_pieces)
+        self.pieces = {}    # piece_index -> PieceDownload
+        self.window = RequestWindow()
+        self.decoder = peer_protocol.MessageDecoder()
+        self.outgoing = peer_protocol.OutgoingQueue()
+        self.limiter = swarm.bandwidth.peer(swarm.info_hash) if swarm.bandwidth is not None else None
+        self.half_open = False      # holds a half-open slot of swarm.limits
+        self.holds_slot = False     # holds a connection slot of swarm.limits
+        self.closed = False
+
+    def __repr__(self):
+        return f"{self.peer_ip}:{self.peer_port}"
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.peer_ip, self.peer_port), CONNECT_TIMEOUT)
+        self.writer.write(peer_protocol.build_handshake(self.swarm.info_hash, self.swarm.peer_id))
+        await self.writer.drain()
+        handshake = await asyncio.wait_for(
+            self.reader.readexactly(peer_protocol.HANDSHAKE_LENGTH), CONNECT_TIMEOUT)
+        peer_protocol.parse_handshake(handshake, self.swarm.info_hash)
+        self.outgoing.interested()
+        await self.flush()
+
+    async def flush(self):
+        """Sends everything queued during this loop iteration at once"""
+        self.outgoing.flush_to(self.writer)
+        await self.writer.drain()
+
+    async def receive_messages(self):
+        """
+        Reads whatever the socket has and decodes all complete messages in it.
+
+        Returns:
+            list: [(message_id: int or None for keep-alive, payload: memoryview)]
+        """
+        data = await asyncio.wait_for(self.reader.read(RECV_SIZE), MESSAGE_TIMEOUT)
+        if not data:
+            raise ConnectionResetError("Connection closed by peer")
+        if self.limiter is not None:
+            await self.limiter.download(len(data))
+        return self.decoder.feed(data)
+
+    async def message_loop(self):
+        while not self.swarm.is_complete():
+            for message_id, payload in await self.receive_messages():
+                self.handle_message(message_id, payload)
+            # One refill and one write per batch of messages
+            self.fill_requests()
+            await self.flush()
+            if self.swarm.drain is not None:
+                # Stops reading from the peer while the disk is behind
+                await self.swarm.drain()
+
+    def handle_message(self, message_id, payload):
+        if message_id == peer_protocol.MSG_CHOKE:
+            self.peer_choking = True
+            # The peer discards our open requests
+            self.drop_requests()
+        elif message_id == peer_protocol.MSG_UNCHOKE:
+            self.peer_choking = False
+            self.last_block_at = time.monotonic()
+        elif message_id == peer_protocol.MSG_HAVE:
+            index = struct.unpack('>I', payload)[0]
+            if self.have.add(index):
+                self.swarm.picker.peer_have(self.have, index)
+        elif message_id == peer_protocol.MSG_BITFIELD:
+            self.swarm.picker.peer_lost(self.have)
+            self.have = Bitfield.from_payload(payload, self.swarm.num_pieces)
+            self.swarm.picker.peer_bitfield(self.have)
+        elif message_id == peer_protocol.MSG_PIECE:
+            self.handle_piece(payload)
+
+    def handle_piece(self, payload):
+        index, begin, block_data = peer_protocol.parse_piece(payload)
+        if not self.window.on_block(index, begin, len(block_data)):
+            # Cancelled or never requested
+            self.swarm.bytes_wasted += len(block_data)
+            return
+        self.last_block_at = time.monotonic()
+        self.snubbed = False
+        self.swarm.block_received(self, index, begin, block_data)
+
+    def request_block(self, piece, begin, length):
+        self.outgoing.request(piece.index, begin, length)
+        self.window.on_request(piece.index, begin, length)
+        piece.requesters.setdefault(begin, []).append(self)
+
+    def cancel_request(self, piece_index, begin, length):
+        """Withdraws a request whose block already came from another peer (endgame)"""
+        if not self.window.cancel(piece_index, begin):
+            return
+        self.outgoing.cancel(piece_index, begin, length)
+        self.swarm.cancels_sent += 1
+        if self.writer is not None:
+            # Sent right away, not at the end of this peer's next loop iteration
+            self.outgoing.flush_to(self.writer)
+
+    def drop_requests(self):
+        for index, begin, length in self.window.cancel_all():
+            self.swarm.request_dropped(self, index, begin, length)
+
+    def snub(self):
+        """
+        The peer sent nothing for SNUB_TIMEOUT although it has our requests:
+        they and its pieces move to other peers. From now on it only gets a
+        single probe request for a block of another peer's piece.
+        """
+        if not self.snubbed:
+            self.snubbed = True
+            print(f"Peer {self} snubbed us, reassigning {len(self.window.outstanding)} requests")
+        for index, begin, length in self.window.cancel_all():
+            self.outgoing.cancel(index, begin, length)
+            self.swarm.request_dropped(self, index, begin, length)
+        for piece in self.pieces.values():
+            self.swarm.release_piece(piece)
+        self.pieces.clear()
+        if self.writer is not None:
+            self.outgoing.flush_to(self.writer)
+
+    def has_room(self):
+        if self.snubbed:
+            return not self.window.outstanding
+        return self.window.has_room()
+
+    def fill_requests(self):
+        if self.peer_choking:
+            return
+        if self.snubbed:
+            self.fill_endgame_requests()
+            return
+        while self.has_room():
+            piece = self.next_piece()
+            if piece is None:
+                break
+            begin, length = piece.pending.popleft()
+            self.request_block(piece, begin, length)
+        else:
+            return
+        if self.swarm.check_endgame():
+            self.fill_endgame_requests()
+
+    def fill_endgame_requests(self):
+        """
+        Endgame: every missing piece is being downloaded already. Requests
+        blocks of other peers' pieces, unrequested ones first, then blocks that
+        are still outstanding elsewhere; the first copy to arrive wins.
+        """
+        for piece in list(self.swarm.downloads.values()):
+            if piece.index not in self.have:
+                continue
+            while piece.pending:
+                if not self.has_room():
+                    return
+                begin, length = piece.pending.popleft()
+                self.request_block(piece, begin, length)
+            for begin, requesters in list(piece.requesters.items()):
+                if not self.has_room():
+                    return
+                if self not in requesters and len(requesters) < ENDGAME_MAX_REQUESTS:
+                    self.request_block(piece, begin, piece.block_length(begin))
+
+    def next_piece(self):
+        """Piece with unrequested blocks, assigns a new one from the swarm if needed"""
+        for piece in self.pieces.values():
+            if piece.pending:
+                return piece
+        piece = self.swarm.adopt_piece(self)
+        if piece is not None:
+            return piece
+        index = self.swarm.assign_piece(self)
+        if index is None:
+            return None
+        length = self.swarm.piece_length(index)
+        if not self.swarm.reserve_buffer(length):
+            # The session's buffer budget is used up, the open pieces have to finish first
+            self.swarm.picker.release(index)
+            return None
+        piece = PieceDownload(index, length, self.swarm.torrent.piece_hash(index), self, self.swarm.verifier)
+        self.pieces[index] = piece
+        self.swarm.downloads[index] = piece
+        return piece
+
+    def connected(self):
+        """The handshake is done (or failed), the half-open slot is free again"""
+        if self.half_open:
+            self.half_open = False
+            self.swarm.limits.half_open.release()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.drop_requests()
+        for piece in self.pieces.values():
+            self.swarm.release_piece(piece)
+        self.pieces.clear()
+        self.swarm.picker.peer_lost(self.have)
+        if self.limiter is not None:
+            self.limiter.close()
+        self.connected()
+        if self.holds_slot:
+            self.holds_slot = False
+            self.swarm.limits.connections.release()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Swarm:
+    """
+    Downloads a torrent from many peers at once.
+
+    Parameters:
+        torrent (torrent_file.Torrent): metadata
+        info_hash (bytes): 20-byte SHA1-Hash
+        peer_id (bytes): 20-byte Peer-ID
+        on_piece (callable): on_piece(piece_index, piece_data) for every verified piece
+        max_connections (int): cap on concurrent peer connections
+        max_half_open (int): cap on connection attempts in flight
+        backoff (peer_backoff.PeerBackoff): failure record of peers, shared between runs
+        bandwidth (bandwidth.BandwidthScheduler): download caps, None = unlimited
+        limits (session.SessionLimits): connection, half-open and piece buffer budgets
+            shared with other torrents, None = only max_connections and max_half_open apply
+        drain (coroutine function): awaited by every connection after each batch of
+            messages, e.g. storage.Storage.drain; may raise storage.StorageError
+        verifier (verifier.PieceVerifier): threads that hash the blocks as they arrive,
+            a private one is created if None
+    """
+
+    def __init__(self, torrent, info_hash, peer_id, on_piece, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_half_open=DEFAULT_MAX_HALF_OPEN, backoff=None, bandwidth=None, limits=None, drain=None,
+                 verifier=None):
+        self.torrent = torrent
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.on_piece = on_piece
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+        self.backoff = backoff if backoff is not None else PeerBackoff()
+        self.bandwidth = bandwidth
+        self.limits = limits
+        self.drain = drain
+        self.owns_verifier = verifier is None
+        self.verifier = verifier if verifier is not None else PieceVerifier()
+        self.loop = None
+        self.candidates = deque()
+        self.queued = set()         # peers in candidates
+        self.deferred = set()       # peers waiting for their backoff to expire
+        self.active_peers = set()   # peers being dialed or connected
+        self.new_peers = asyncio.Event()
+        self.num_pieces = torrent.num_pieces
+        self.picker = PiecePicker(self.num_pieces)
+        self.connections = set()
+        self.downloads = {}         # piece_index -> PieceDownload, shared by all connections
+        self.orphans = {}           # piece_index -> partly received PieceDownload without owner
+        self.done = asyncio.Event()
+        # Endgame statistics
+        self.endgame_started = None
+        self.endgame_finished = None
+        self.bytes_wasted = 0       # duplicate or unrequested block data
+        self.blocks_rescued = 0     # blocks that arrived first from an endgame duplicate request
+        self.cancels_sent = 0
+
+    def piece_length(self, piece_index):
+        return self.torrent.piece_size(piece_index)
+
+    def is_complete(self):
+        return self.picker.is_complete()
+
+    def assign_piece(self, conn):
+        """
+        Returns:
+            int: rarest missing piece the peer has and nobody else downloads, or None
+        """
+        return self.picker.pick(conn.have)
+
+    def release_piece(self, piece):
+        """
+        The owner of the piece is gone or snubbed. Another peer with open
+        requests for it takes it over; a partly received piece waits in
+        `orphans` for the next peer that has it, otherwise it goes back to the
+        picker.
+        """
+        for requesters in piece.requesters.values():
+            if requesters:
+                piece.owner = requesters[0]
+                piece.owner.pieces[piece.index] = piece
+                return
+        piece.owner = None
+        if piece.received:
+            self.orphans[piece.index] = piece
+            return
+        del self.downloads[piece.index]
+        self.free_buffer(piece)
+        self.picker.release(piece.index)
+
+    def reserve_buffer(self, length):
+        return self.limits is None or self.limits.buffers.acquire(length)
+
+    def free_buffer(self, piece):
+        if self.limits is not None:
+            self.limits.buffers.release(piece.length)
+
+    def adopt_piece(self, conn):
+        """
+        Returns:
+            PieceDownload: orphaned piece the peer has, now owned by it, or None
+        """
+        for index, piece in self.orphans.items():
+            if index in conn.have:
+                del self.orphans[index]
+                piece.owner = conn
+                conn.pieces[index] = piece
+                return piece
+        return None
+
+    def check_snubbed(self, now=None):
+        now = time.monotonic() if now is None else now
+        for conn in list(self.connections):
+            # Snubbed peers are checked again, so a probe that gets no answer is reassigned too
+            if not conn.peer_choking and conn.window.outstanding and now - conn.last_block_at > SNUB_TIMEOUT:
+                conn.snub()
+
+    def refill_idle(self):
+        """Connections without requests out got no piece buffer from the session, they try again"""
+        for conn in list(self.connections):
+            if conn.writer is not None and not conn.peer_choking and not conn.window.outstanding:
+                conn.fill_requests()
+                conn.outgoing.flush_to(conn.writer)
+
+    def defer(self, peer):
+        """Keeps a backing-off peer until housekeeping finds its backoff expired"""
+        if not self.backoff.gave_up(peer):
+            self.deferred.add(peer)
+
+    def requeue_deferred(self, now=None):
+        """Peers whose backoff expired are queued again, those the backoff gave up on are dropped"""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for peer in list(self.deferred):
+            if self.backoff.is_ready(peer, now):
+                ready.append(peer)
+            elif not self.backoff.gave_up(peer):
+                continue
+            self.deferred.discard(peer)
+        if ready:
+            self.add_peers(ready)
+
+    async def housekeeping(self):
+        while True:
+            await asyncio.sleep(SNUB_CHECK_INTERVAL)
+            self.check_snubbed()
+            self.requeue_deferred()
+            if self.limits is not None:
+                self.refill_idle()
+
+    def download_rate(self, peer_ip):
+        """
+        Returns:
+            float: bytes/s we currently receive from that address, 0 for snubbing peers
+        """
+        return sum(conn.window.rate() for conn in self.connections
+                   if conn.peer_ip == peer_ip and not conn.snubbed)
+
+    def check_endgame(self):
+        """
+        Returns:
+            bool: True once every missing piece is being downloaded
+        """
+        if self.endgame_started is None and not self.picker.has_wanted() and not self.is_complete():
+            self.endgame_started = time.monotonic()
+            print(f"Endgame: {len(self.downloads)} pieces left, {len(self.connections)} peers")
+        return self.endgame_started is not None
+
+    def request_dropped(self, conn, piece_index, begin, length):
+        """A request of conn was dropped (choke or disconnect), the block is requested again if needed"""
+        piece = self.downloads.get(piece_index)
+        if piece is None:
+            return
+        requesters = piece.requesters.get(begin)
+        if requesters is not None and conn in requesters:
+            requesters.remove(conn)
+            if requesters:
+                return
+            del piece.requesters[begin]
+        if not piece.has_block(begin):
+            piece.pending.appendleft((begin, length))
+
+    def block_received(self, conn, piece_index, begin, block_data):
+        piece = self.downloads.get(piece_index)
+        if piece is None:
+            # Piece finished or released meanwhile
+            self.bytes_wasted += len(block_data)
+            return
+        requesters = piece.requesters.pop(begin, [])
+        if not piece.add_block(begin, block_data):
+            self.bytes_wasted += len(block_data)
+            return
+        for other in requesters:
+            if other is not conn:
+                other.cancel_request(piece_index, begin, len(block_data))
+        if requesters and requesters[0] is not conn:
+            self.blocks_rescued += 1
+        if piece.is_complete():
+            del self.downloads[piece_index]
+            self.free_buffer(piece)
+            self.orphans.pop(piece_index, None)
+            if piece.owner is not None:
+                piece.owner.pieces.pop(piece_index, None)
+            piece.when_digested(lambda piece: self.piece_digested(conn, piece))
+
+    def piece_digested(self, conn, piece):
+        """Called from a verifier thread once the last block went through SHA1"""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.piece_downloaded, conn, piece)
+
+    def endgame_stats(self):
+        """
+        Returns:
+            dictionary: endgame duration (None if not reached), wasted bytes, rescued blocks, cancels
+        """
+        duration = None
+        if self.endgame_started is not None:
+            duration = (self.endgame_finished or time.monotonic()) - self.endgame_started
+        return {
+            'endgame_seconds': duration,
+            'bytes_wasted': self.bytes_wasted,
+            'blocks_rescued': self.blocks_rescued,
+            'cancels_sent': self.cancels_sent,
+        }
+
+    def piece_downloaded(self, conn, piece):
+        """The piece was hashed while its blocks arrived, only the digest is compared here"""
+        piece_index = piece.index
+        if not piece.is_valid():
+            print(f"Hash mismatch for piece {piece_index} from {conn}")
+            self.picker.release(piece_index)
+            return
+        if not self.picker.complete(piece_index):
+            return
+        self.on_piece(piece_index, piece.data)
+        print(f"Downloaded piece {piece_index} ({self.picker.num_done}/{self.num_pieces}) "
+              f"from {conn}, {len(self.connections)} peers")
+        if self.is_complete():
+            if self.endgame_started is not None:
+                self.endgame_finished = time.monotonic()
+            stats = self.endgame_stats()
+            print(f"Endgame: {stats['endgame_seconds'] or 0:.2f} s, {stats['bytes_wasted']} bytes wasted, "
+                  f"{stats['blocks_rescued']} blocks rescued, {stats['cancels_sent']} cancels")
+            self.done.set()
+
+    def add_peers(self, peers):
+        """
+        Queues candidates, also while run() is active: every re-announce hands
+        in its whole peer list, so peers that disconnected are dialed again.
+        Peers already queued, being dialed, connected or backing off are skipped.
+        """
+        for peer in peers:
+            if peer not in self.active_peers and peer not in self.queued and peer not in self.deferred:
+                self.candidates.append(peer)
+                self.queued.add(peer)
+        self.new_peers.set()
+
+    def wakeup(self):
+        """Lets run() try to dial again, e.g. after the session raised max_connections"""
+        self.new_peers.set()
+
+    def reserve_dial(self):
+        """
+        Returns:
+            bool: False if the session has no connection or half-open slot left
+        """
+        if self.limits is None:
+            return True
+        if not self.limits.connections.acquire():
+            return False
+        if not self.limits.half_open.acquire():
+            self.limits.connections.release()
+            return False
+        return True
+
+    async def dial(self, conn):
+        """
+        Returns:
+            PeerConnection: conn after a successful handshake, None on failure
+        """
+        peer = (conn.peer_ip, conn.peer_port)
+        try:
+            await conn.connect()
+        except PEER_ERRORS as e:
+            self.backoff.failed(peer)
+            print(f"Peer {conn} failed: {e!r}")
+            conn.close()
+            return None
+        finally:
+            conn.connected()
+        self.backoff.succeeded(peer)
+        return conn
+
+    async def serve(self, conn):
+        self.connections.add(conn)
+        try:
+            await conn.message_loop()
+        except PEER_ERRORS as e:
+            print(f"Peer {conn} failed: {e!r}")
+        finally:
+            conn.close()
+            self.connections.discard(conn)
+
+    def start_dials(self, dialing, serving):
+        """Dials queued candidates, bounded by max_half_open and max_connections"""
+        while (self.candidates and len(dialing) < self.max_half_open
+               and len(dialing) + len(serving) < self.max_connections):
+            peer = self.candidates.popleft()
+            self.queued.discard(peer)
+            if peer in self.active_peers:
+                continue
+            if not self.backoff.is_ready(peer):
+                self.defer(peer)
+                continue
+            if not self.reserve_dial():
+                # Other torrents hold the session's slots, retried on wakeup()
+                self.candidates.appendleft(peer)
+                self.queued.add(peer)
+                break
+            self.active_peers.add(peer)
+            conn = PeerConnection(self, *peer)
+            conn.half_open = conn.holds_slot = self.limits is not None
+            task = asyncio.create_task(self.dial(conn))
+            dialing[task] = conn
+
+    async def run(self, peers, wait_for_peers=False):
+        """
+        Downloads until all pieces are done.
+
+        Dials up to max_half_open candidates at once and hands every peer that
+        completed its handshake to its own connection task, so the fastest
+        peers start downloading first and dead peers only cost a short timeout.
+
+        Parameters:
+            peers (list): [(ip, port)]
+            wait_for_peers (bool): wait for add_peers() when no candidate is left
+                instead of giving up (peers come from re-announces)
+        """
+        self.loop = asyncio.get_running_loop()
+        self.add_peers(self.backoff.order(peers))
+        dialing = {}            # task -> PeerConnection
+        serving = {}            # task -> peer
+        waiter = asyncio.create_task(self.done.wait())
+        housekeeping = asyncio.create_task(self.housekeeping())
+        try:
+            while not waiter.done():
+                self.new_peers.clear()
+                self.start_dials(dialing, serving)
+                if not dialing and not serving and not wait_for_peers:
+                    break
+                new_peers = asyncio.create_task(self.new_peers.wait())
+                done, _ = await asyncio.wait([*dialing, *serving, waiter, new_peers],
+                                             return_when=asyncio.FIRST_COMPLETED)
+                new_peers.cancel()
+                for task in done:
+                    if task in dialing:
+                        conn = dialing.pop(task)
+                        peer = (conn.peer_ip, conn.peer_port)
+                        if task.result() is None:
+                            self.active_peers.discard(peer)
+                            self.defer(peer)
+                        else:
+                            serving[asyncio.create_task(self.serve(conn))] = peer
+                    elif task in serving:
+                        self.active_peers.discard(serving.pop(task))
+                        # Peer errors end in serve(), anything else (storage.StorageError) ends the download
+                        task.result()
+        finally:
+            tasks = [*dialing, *serving, waiter, housekeeping]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Dials cancelled before they started never closed their connection
+            for conn in dialing.values():
+                conn.close()
+            self.active_peers.clear()
+            if self.limits is not None:
+                # Partly downloaded pieces are dropped, their buffers go back to the session
+                for index, piece in self.downloads.items():
+                    self.free_buffer(piece)
+                    self.picker.release(index)
+                self.downloads.clear()
+                self.orphans.clear()
+            if self.owns_verifier:
+                self.verifier.shutdown(wait=False)
+        if not self.is_complete():
+            raise Exception(f"Swarm exhausted, {self.picker.remaining()} pieces missing")
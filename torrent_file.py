@@ -1,31 +1,122 @@
 import hashlib
-from bencode import bencode_encode, decode_dict
+import mmap
+from bencode import bencode_encode, decode_torrent
 from urllib import parse
 import secrets
 import string
 
-def parse_torrent_file(filename):
+def read_torrent_file(filename):
+    """
+    Liest eine .torrent-Datei.
+
+    Returns:
+        tuple: (torrent_data: dict, info_hash: bytes) - der Info-Hash wird über
+               die Original-Bytes des info-Dictionarys berechnet, ohne re-encode
+    """
     with open(filename, 'rb') as f:
         data = f.read()
     
     print(f"File size: {len(data)} bytes")
-    print("Starting parse...")
-    
 
-    torrent_data, length = decode_dict(data.decode('latin-1'), 0)
-    
-    print(f"Parsed {length} characters")
+    torrent_data, info_bytes = decode_torrent(data)
+    info_hash = hashlib.sha1(info_bytes).digest()
+    return torrent_data, info_hash
+
+def parse_torrent_file(filename):
+    torrent_data, _ = read_torrent_file(filename)
     return torrent_data
 
+
+class Torrent:
+    """
+    Metadaten eines Torrents, einmal beim Laden vorberechnet.
+
+    Gesamtgröße, Anzahl Pieces und Länge der letzten Piece werden nur einmal
+    berechnet; die Piece-Hashes sind ein memoryview auf die rohe 20-byte
+    Tabelle, piece_hash() ist damit ein Slice ohne Kopie. Mit use_mmap wird
+    die Datei memory-mapped und die Hash-Tabelle gar nicht erst kopiert
+    (die Map bleibt offen solange das Objekt lebt).
+
+    Alter dict-Zugriff (torrent['info']) geht weiter auf die Rohdaten.
+    """
+
+    __slots__ = ('meta', 'info', 'info_hash', 'name', 'announce', 'announce_list',
+                 'piece_length', 'total_size', 'num_pieces', 'last_piece_length',
+                 'piece_hashes', 'files', 'mmap')
+
+    # Ab dieser Länge werden Strings nicht kopiert (praktisch nur 'pieces')
+    VIEW_THRESHOLD = 64 * 1024
+
+    def __init__(self, data, mapped=None):
+        self.mmap = mapped
+        self.meta, info_bytes = decode_torrent(data, self.VIEW_THRESHOLD)
+        self.info_hash = hashlib.sha1(info_bytes).digest()
+        info = self.info = self.meta['info']
+        self.name = text(info['name'])
+        self.announce = text(self.meta['announce']) if 'announce' in self.meta else None
+        self.announce_list = [[text(url) for url in tier] for tier in self.meta.get('announce-list', [])]
+
+        self.piece_length = info['piece length']
+        if 'length' in info:
+            self.files = None
+            self.total_size = info['length']
+        else:
+            self.files = [(tuple(text(part) for part in f['path']), f['length']) for f in info['files']]
+            self.total_size = sum(length for _, length in self.files)
+
+        self.piece_hashes = memoryview(info['pieces'])
+        if len(self.piece_hashes) % 20:
+            raise ValueError(f"Length of pieces ({len(self.piece_hashes)}) is not a multiple of 20")
+        self.num_pieces = len(self.piece_hashes) // 20
+        if self.num_pieces != (self.total_size + self.piece_length - 1) // self.piece_length:
+            raise ValueError(f"{self.num_pieces} pieces do not match a total size of {self.total_size} bytes")
+        self.last_piece_length = self.total_size - (self.num_pieces - 1) * self.piece_length
+
+    @classmethod
+    def from_file(cls, filename, use_mmap=False):
+        with open(filename, 'rb') as f:
+            if not use_mmap:
+                return cls(f.read())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapped), mapped)
+
+    def piece_size(self, piece_index):
+        if piece_index == self.num_pieces - 1:
+            return self.last_piece_length
+        return self.piece_length
+
+    def piece_hash(self, piece_index):
+        """
+        Returns:
+            memoryview: erwarteter 20-byte SHA1-Hash der Piece
+        """
+        start = piece_index * 20
+        return self.piece_hashes[start:start + 20]
+
+    def __getitem__(self, key):
+        return self.meta[key]
+
+    def __contains__(self, key):
+        return key in self.meta
+
+def text(value):
+    """Strings im Torrent sind Bytes, meist UTF-8"""
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    return value
+
 def show_torrent_info(torrent_data):
     print("=" * 50)
     print("TORRENT INFO")
     print("=" * 50)
-    print(f"Tracker: {torrent_data['announce']}")
+    print(f"Tracker: {text(torrent_data['announce'])}")
     
     info = torrent_data['info']
     print(f"\nFile Info:")
-    print(f"  Name: {info['name']}")
+    print(f"  Name: {text(info['name'])}")
     print(f"  Piece Length: {info['piece length']} bytes")
     
     # Single-File oder Multi-File?
@@ -41,7 +132,7 @@ def show_torrent_info(torrent_data):
         print(f"  Total Size: {total_size} bytes ({total_size / (1024*1024):.2f} MB)")
         print(f"\n  Files:")
         for i, file in enumerate(info['files'][:5], 1):  # Zeige ersten 5
-            path = '/'.join(file['path'])
+            path = '/'.join(text(part) for part in file['path'])
             print(f"    {i}. {path} - {file['length']} bytes")
         if len(info['files']) > 5:
             print(f"    ... and {len(info['files']) - 5} more files")
@@ -59,7 +150,7 @@ def calculate_info_hash(info_dict):
     return info_hash
 
 def get_tracker_and_port(torrent_data):
-    tracker = torrent_data['announce']
+    tracker = text(torrent_data['announce'])
     tracker = tracker[6:]
     tracker, port = tracker.split(":")
     port = port.split("/")
@@ -1,9 +1,17 @@
 import string
 import secrets
-from torrent_file import parse_torrent_file, calculate_info_hash, show_torrent_info
+from torrent_file import parse_torrent_file, calculate_info_hash, show_torrent_info, text
 from urllib import parse
+import threading
 import requests
-from bencode import decode_dict
+from requests.adapters import HTTPAdapter
+from bencode import decode
+from compact_peers import decode_peers, merge_peers
+
+MAX_HTTP_SCRAPE_HASHES = 50     # keeps the URL below common length limits
+HTTP_TIMEOUT = 10
+HTTP_POOL_SIZE = 4
+
 def generate_peer_id():
     start = "-PC0001-"
     length = 12
@@ -12,9 +20,16 @@ def generate_peer_id():
     id = id.encode()
     return id
 
-def build_tracker_url(tracker_url, info_hash, peer_id, port, uploaded, downloaded, left):
+def build_tracker_url(tracker_url, info_hash, peer_id, port, uploaded, downloaded, left, event=None, numwant=None):
+    info_hash = parse.quote_from_bytes(info_hash)
     peer_id = parse.quote_from_bytes(peer_id)
-    return f"{tracker_url}?info_hash={info_hash}&peer_id={peer_id}&port={port}&uploaded={uploaded}&downloaded={downloaded}&left={left}&compact=1"
+    separator = '&' if '?' in tracker_url else '?'
+    url = f"{tracker_url}{separator}info_hash={info_hash}&peer_id={peer_id}&port={port}&uploaded={uploaded}&downloaded={downloaded}&left={left}&compact=1"
+    if event:
+        url += f"&event={event}"
+    if numwant is not None:
+        url += f"&numwant={numwant}"
+    return url
 
 def contact_tracker(tracker_url, info_hash, peer_id, port, uploaded, downloaded, left):
     url = build_tracker_url(tracker_url, info_hash, peer_id, port, uploaded, downloaded, left)
@@ -28,8 +43,122 @@ def contact_tracker(tracker_url, info_hash, peer_id, port, uploaded, downloaded,
     
     return req.content  
 
+class HttpTrackerClient:
+    """
+    HTTP tracker client with one pooled keep-alive session per tracker host.
+
+    Periodic announces and scrapes for many torrents reuse the open
+    connections of their tracker instead of paying DNS, TCP and TLS setup
+    every time. Methods block and are meant to run in a worker thread.
+
+    Parameters:
+        timeout (float): request timeout in seconds
+        pool_size (int): max. open connections per tracker host
+    """
+
+    def __init__(self, timeout=HTTP_TIMEOUT, pool_size=HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.sessions = {}      # (scheme, host) -> requests.Session
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        parts = parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.headers['User-Agent'] = 'Python-BitTorrent-Client/1.0'
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(f"{parts.scheme}://", adapter)
+                self.sessions[key] = session
+            return session
+
+    def get(self, url):
+        req = self.session(url).get(url, timeout=self.timeout)
+        if req.status_code != 200:
+            raise Exception(f"Tracker error: {req.status_code}")
+        return req.content
+
+    def announce(self, tracker_url, info_hash, peer_id, port, uploaded, downloaded, left,
+                 event=None, numwant=None):
+        """
+        Parameters:
+            event (str): "started", "completed", "stopped" or None for a regular announce
+            numwant (int): number of peers wanted, None = tracker default
+
+        Returns:
+            dictionary: tracker response, 'peers' decoded to [(ip, port)]
+        """
+        url = build_tracker_url(tracker_url, info_hash, peer_id, port, uploaded, downloaded, left, event, numwant)
+        tracker_data = parse_response(self.get(url))
+        tracker_data['peers'] = get_peers(tracker_data)
+        return tracker_data
+
+    def scrape(self, tracker_url, info_hashes):
+        """see scrape"""
+        return scrape(tracker_url, info_hashes, self.get)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+def scrape_url(tracker_url):
+    """
+    Scrape URL of an HTTP tracker (convention: last path component "announce..." -> "scrape...").
+
+    Returns:
+        string: scrape URL, or None if the tracker does not support scrape
+    """
+    parts = parse.urlsplit(tracker_url)
+    directory, _, last = parts.path.rpartition('/')
+    if not last.startswith('announce'):
+        return None
+    path = f"{directory}/scrape{last[len('announce'):]}"
+    return parse.urlunsplit(parts._replace(path=path))
+
+def build_scrape_url(url, info_hashes):
+    query = '&'.join(f"info_hash={parse.quote_from_bytes(info_hash)}" for info_hash in info_hashes)
+    separator = '&' if '?' in url else '?'
+    return f"{url}{separator}{query}"
+
+def scrape(tracker_url, info_hashes, get=None):
+    """
+    Scrapes several torrents with one request per MAX_HTTP_SCRAPE_HASHES info hashes.
+
+    Parameters:
+        get (callable): get(url) -> response body, e.g. HttpTrackerClient.get
+
+    Returns:
+        dictionary: info_hash -> {seeders, completed, leechers}, like udp_tracker.parse_scrape_response
+    """
+    url = scrape_url(tracker_url)
+    if url is None:
+        raise Exception(f"Tracker does not support scrape: {tracker_url}")
+    if get is None:
+        get = HttpTrackerClient().get
+    info_hashes = list(info_hashes)
+    result = {}
+    for start in range(0, len(info_hashes), MAX_HTTP_SCRAPE_HASHES):
+        response = get(build_scrape_url(url, info_hashes[start:start + MAX_HTTP_SCRAPE_HASHES]))
+        result.update(parse_scrape_response(response))
+    return result
+
+def parse_scrape_response(response):
+    scrape_data, _ = decode(response)
+    if 'failure reason' in scrape_data:
+        raise Exception(f"Tracker says: {text(scrape_data['failure reason'])}")
+    # Keys of the files dict are the raw info hashes, decoded as latin-1
+    return {info_hash.encode('latin-1'): {'seeders': stats.get('complete', 0),
+                                          'completed': stats.get('downloaded', 0),
+                                          'leechers': stats.get('incomplete', 0)}
+            for info_hash, stats in scrape_data.get('files', {}).items()}
+
 def find_working_tracker(torrent):
-    info_hash = calculate_info_hash(torrent)
+    info_hash = calculate_info_hash(torrent['info'])
     peer_id = generate_peer_id()
     port = 6881
     uploaded = 0
@@ -47,10 +176,10 @@ def find_working_tracker(torrent):
 
         for tier in torrent['announce-list']:
             for url in tier:
-                trackers.append(url)
+                trackers.append(text(url))
     elif 'announce' in torrent:
 
-        trackers.append(torrent['announce'])
+        trackers.append(text(torrent['announce']))
     else:
         raise Exception("No trackers found in torrent!")
     
@@ -71,33 +200,53 @@ def find_working_tracker(torrent):
 
 
 def parse_response(response):
-    tracker_data, _ = decode_dict(response.decode('latin-1'), 0)
+    tracker_data, _ = decode(response)
     if 'failure reason' in tracker_data:
-        raise Exception(f"Tracker says: {tracker_data['failure reason']}")
+        raise Exception(f"Tracker says: {text(tracker_data['failure reason'])}")
     else:
         print(f"Success! Got peers!")
         return tracker_data
 
+def get_peers(tracker_data):
+    """
+    Peers aus einer Tracker-Antwort: kompakt (6 Bytes pro Peer, BEP 23), als Liste von Dicts
+    und IPv6-Peers aus "peers6" (18 Bytes pro Peer, BEP 7). Doppelte Peers werden entfernt.
+
+    Returns:
+        list: [(ip, port)]
+    """
+    peers = tracker_data.get('peers', b'')
+    if isinstance(peers, list):
+        peers = [(text(peer['ip']), peer['port']) for peer in peers]
+    else:
+        peers = decode_peers(peers)
+    peers6 = tracker_data.get('peers6', b'')
+    if not peers6:
+        return merge_peers(peers)
+    return merge_peers(peers, decode_peers(peers6, ipv6=True))
 
-torrent = parse_torrent_file("fun/torrent/debian-13.1.0-amd64-netinst.iso.torrent")
-
-print("All keys in torrent:")
-print(torrent.keys())
 
-print("\nAll keys in info:")
-print(torrent['info'].keys())
-
-print("\nFull torrent (first level):")
-for key in torrent.keys():
-    if key == 'info':
-        print(f"  {key}: <dict with {len(torrent[key])} keys>")
-    else:
-        value = torrent[key]
-        if isinstance(value, bytes) and len(value) > 50:
-            print(f"  {key}: <bytes, {len(value)} bytes>")
-        else:
-            print(f"  {key}: {value}")
-find_working_tracker(torrent)
+def main():
+    "Teste HTTP Tracker"
+    torrent = parse_torrent_file("fun/torrent/debian-13.1.0-amd64-netinst.iso.torrent")
 
+    print("All keys in torrent:")
+    print(torrent.keys())
 
+    print("\nAll keys in info:")
+    print(torrent['info'].keys())
 
+    print("\nFull torrent (first level):")
+    for key in torrent.keys():
+        if key == 'info':
+            print(f"  {key}: <dict with {len(torrent[key])} keys>")
+        else:
+            value = torrent[key]
+            if isinstance(value, bytes) and len(value) > 50:
+                print(f"  {key}: <bytes, {len(value)} bytes>")
+            else:
+                print(f"  {key}: {value}")
+    find_working_tracker(torrent)
+
+if __name__ == "__main__":
+    main()
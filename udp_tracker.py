@@ -1,14 +1,19 @@
+import asyncio
 import struct
 import socket
+import time
 import random
 import torrent_file
 import secrets
 import string
+from compact_peers import decode_peers
 
 # UDP Tracker Protocol Constants
 PROTOCOL_ID = 0x41727101980
 ACTION_CONNECT = 0
 ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
 EVENT_NONE = 0
 EVENT_COMPLETED = 1
 EVENT_STARTED = 2
@@ -19,6 +24,9 @@ CONNECT_REQUEST_SIZE = 16
 CONNECT_RESPONSE_SIZE = 16
 ANNOUNCE_RESPONSE_HEADER_SIZE = 20
 PEER_SIZE = 6
+SCRAPE_RESPONSE_HEADER_SIZE = 8
+SCRAPE_ENTRY_SIZE = 12
+MAX_SCRAPE_HASHES = 74      # info hashes per scrape packet, keeps requests below ~1500 bytes
 DEFAULT_BUFFER_SIZE = 1024
 
 # Defaults
@@ -26,6 +34,12 @@ DEFAULT_PORT = 6881
 DEFAULT_NUM_WANT = -1
 DEFAULT_TIMEOUT = 5.0
 
+# BEP 15 timeouts
+BEP15_BASE_TIMEOUT = 15.0
+BEP15_MAX_RETRIES = 8
+QUICK_MAX_RETRIES = 0       # one attempt per step for callers that wait on the answer
+CONNECTION_ID_LIFETIME = 60.0
+
 def build_connect_request():
     """
     Builds a packet which is used to Connect to a UDP tracker.
@@ -58,10 +72,10 @@ def send_request(tracker_host, tracker_port, packet):
         return response, addr
             
     except socket.gaierror as e:
-        raise(f"Host name is invalid. Given host name is {tracker_host}. Check the torrent info.")
+        raise Exception(f"Host name is invalid. Given host name is {tracker_host}. Check the torrent info.") from e
         
     except socket.timeout as e:
-        raise(f"Timeout while waiting on tracker {tracker_host}. Maybe try again?")
+        raise Exception(f"Timeout while waiting on tracker {tracker_host}. Maybe try again?") from e
     except socket.error as e:
         raise Exception(f"Socket error: {e}")
     finally:
@@ -84,7 +98,8 @@ def parse_connect_response(data, expected_trans_id):
     
     return (action, trans_id, con_id)
 
-def build_announce_request(con_id, info_hash, peer_id, downloaded, left, uploaded):
+def build_announce_request(con_id, info_hash, peer_id, downloaded, left, uploaded,
+                           event=EVENT_STARTED, port=DEFAULT_PORT, num_want=DEFAULT_NUM_WANT):
     """
     Build a packet for an announce request. 
     Parameter:
@@ -94,6 +109,9 @@ def build_announce_request(con_id, info_hash, peer_id, downloaded, left, uploade
         downloaded()
         left()
         uploaded()
+        event(int): EVENT_NONE, EVENT_COMPLETED, EVENT_STARTED or EVENT_STOPPED
+        port(int): port we listen on
+        num_want(int): number of peers wanted, -1 = tracker default
     Returns:
         packet(bytes)
         trans_id(int): transaction ID
@@ -102,7 +120,6 @@ def build_announce_request(con_id, info_hash, peer_id, downloaded, left, uploade
     trans_id = random.getrandbits(32)
     ip_address = 0
     key = random.getrandbits(32)
-    num_want = DEFAULT_NUM_WANT
     # Q= 64 bit I = 32 bit, H = 16 bit [64,32,32,20bytes,20bytes,64,64,64,32,32,32,32,16], ingesamt 98byte
     struckt_string = ">QII20s20sQQQIIIIH"
     if num_want == -1:
@@ -116,11 +133,11 @@ def build_announce_request(con_id, info_hash, peer_id, downloaded, left, uploade
                           downloaded, 
                           left, 
                           uploaded, 
-                          EVENT_STARTED, 
+                          event, 
                           ip_address, 
                           key, 
                           num_want, 
-                          DEFAULT_PORT) 
+                          port) 
 
     return packet, trans_id
 
@@ -139,12 +156,13 @@ def generate_peer_id():
 
 
 
-def parse_announce_response(response, expected_trans_id):
+def parse_announce_response(response, expected_trans_id, ipv6=False):
     """
     Parses the response of an announce request.
     Parameter:
         response(byte)
         expected_trans_id(int): used for assertion
+        ipv6(bool): response came over IPv6, peers are 18-byte entries (BEP 15)
     Returns: 
         dictionary:
             interval,
@@ -162,18 +180,7 @@ def parse_announce_response(response, expected_trans_id):
 
     assert transaction_id == expected_trans_id, f"Assert failed! trans_id = {transaction_id}, expected = {expected_trans_id}"
 
-    num_peers = (len(response) - ANNOUNCE_RESPONSE_HEADER_SIZE) // PEER_SIZE # 6 Byte per peer
-    peers = []
-    for i in range(num_peers):
-        start = ANNOUNCE_RESPONSE_HEADER_SIZE + i*PEER_SIZE
-        end = start+PEER_SIZE
-
-        peer_data = response[start:end]
-        ip_bytes, port = struct.unpack(">4sH", peer_data)
-
-        ip = socket.inet_ntoa(ip_bytes)
-        peers.append((ip, port))
-
+    peers = decode_peers(memoryview(response)[ANNOUNCE_RESPONSE_HEADER_SIZE:], ipv6)
 
     return {
         'interval': interval,
@@ -182,6 +189,249 @@ def parse_announce_response(response, expected_trans_id):
         'peers': peers
     }
 
+def build_scrape_request(con_id, info_hashes):
+    """
+    Build a packet for a scrape request.
+    Parameter:
+        con_id(int): the Connection ID
+        info_hashes(list): up to MAX_SCRAPE_HASHES 20-byte info hashes
+    Returns:
+        packet(bytes)
+        trans_id(int): transaction ID
+    """
+    if not 0 < len(info_hashes) <= MAX_SCRAPE_HASHES:
+        raise ValueError(f"Scrape needs 1 to {MAX_SCRAPE_HASHES} info hashes, got {len(info_hashes)}")
+    trans_id = random.getrandbits(32)
+    packet = struct.pack('>QII', con_id, ACTION_SCRAPE, trans_id) + b''.join(info_hashes)
+    return packet, trans_id
+
+
+def parse_scrape_response(response, expected_trans_id, info_hashes):
+    """
+    Parses the response of a scrape request. The tracker answers in the order of the request.
+    Parameter:
+        response(byte)
+        expected_trans_id(int): used for assertion
+        info_hashes(list): info hashes of the request
+    Returns:
+        dictionary: info_hash -> {seeders, completed, leechers}
+    """
+    action, transaction_id = struct.unpack_from('>II', response)
+    assert action == ACTION_SCRAPE, f"Assert failed! action = {action}, expected = {ACTION_SCRAPE}"
+    assert transaction_id == expected_trans_id, f"Assert failed! trans_id = {transaction_id}, expected = {expected_trans_id}"
+
+    entries = (len(response) - SCRAPE_RESPONSE_HEADER_SIZE) // SCRAPE_ENTRY_SIZE
+    counts = struct.iter_unpack('>III', response[SCRAPE_RESPONSE_HEADER_SIZE:
+                                                 SCRAPE_RESPONSE_HEADER_SIZE + entries * SCRAPE_ENTRY_SIZE])
+    return {info_hash: {'seeders': seeders, 'completed': completed, 'leechers': leechers}
+            for info_hash, (seeders, completed, leechers) in zip(info_hashes, counts)}
+
+
+class UdpTrackerClient(asyncio.DatagramProtocol):
+    """
+    Long-lived UDP tracker client for all trackers and torrents.
+
+    One socket is shared by every request; responses are matched to their
+    request by transaction ID. Connection IDs are cached per tracker until
+    they expire (BEP 15: one minute), and requests without an answer are
+    sent again after 15 * 2^n seconds, n = 0..max_retries. The full schedule
+    takes about two hours for a dead tracker, so callers that cannot wait
+    that long pass a smaller max_retries per request.
+
+    Parameters:
+        base_timeout (float): first retransmission timeout (15 in BEP 15)
+        max_retries (int): number of retransmissions (8 in BEP 15)
+    """
+
+    def __init__(self, base_timeout=BEP15_BASE_TIMEOUT, max_retries=BEP15_MAX_RETRIES):
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+        self.transport = None
+        self.starting = None        # Future of the endpoint being opened
+        self.waiting = {}           # transaction_id -> (addr, future)
+        self.connection_ids = {}    # addr -> (con_id, expires_at)
+        self.connecting = {}        # addr -> task
+        self.addresses = {}         # (host, port) -> addr
+        self.packets_sent = 0
+
+    async def start(self):
+        """Opens the socket once, concurrent callers wait for the same startup"""
+        if self.transport is not None:
+            return
+        if self.starting is None:
+            loop = asyncio.get_running_loop()
+            self.starting = asyncio.ensure_future(loop.create_datagram_endpoint(
+                lambda: self, local_addr=('0.0.0.0', 0), family=socket.AF_INET))
+            self.starting.add_done_callback(lambda _: setattr(self, 'starting', None))
+        await asyncio.shield(self.starting)
+
+    def close(self):
+        for task in self.connecting.values():
+            task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        for _, future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError("UDP tracker socket closed"))
+        self.waiting.clear()
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        action, trans_id = struct.unpack_from('>II', data)
+        entry = self.waiting.get(trans_id)
+        if entry is None or entry[0] != addr:
+            return
+        future = entry[1]
+        if future.done():
+            return
+        if action == ACTION_ERROR:
+            message = data[8:].decode('utf-8', 'replace')
+            future.set_exception(Exception(f"Tracker error: {message}"))
+        else:
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP errors cannot be matched to a request, the retransmission handles them
+        pass
+
+    def timeout(self, attempt):
+        return self.base_timeout * 2 ** attempt
+
+    def retries(self, max_retries):
+        return self.max_retries if max_retries is None else min(max_retries, self.max_retries)
+
+    def deadline(self, max_retries):
+        """Seconds until a request with max_retries retransmissions gives up"""
+        return sum(self.timeout(attempt) for attempt in range(max_retries + 1))
+
+    async def resolve(self, host, port):
+        addr = self.addresses.get((host, port))
+        if addr is None:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            if not infos:
+                raise Exception(f"Host name is invalid. Given host name is {host}.")
+            addr = infos[0][4]
+            self.addresses[(host, port)] = addr
+        return addr
+
+    async def send(self, addr, packet, trans_id, timeout):
+        """Sends one packet and waits for the response with the same transaction ID"""
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[trans_id] = (addr, future)
+        try:
+            self.transport.sendto(packet, addr)
+            self.packets_sent += 1
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiting.pop(trans_id, None)
+
+    async def connection_id(self, addr, max_retries=None):
+        """
+        The connect handshake is shared by concurrent requests to the same
+        tracker; a caller with fewer retries only waits as long as its own
+        retries would take.
+        """
+        cached = self.connection_ids.get(addr)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        task = self.connecting.get(addr)
+        if task is None:
+            task = asyncio.ensure_future(self._connect(addr))
+            self.connecting[addr] = task
+            task.add_done_callback(lambda _: self.connecting.pop(addr, None))
+        max_retries = self.retries(max_retries)
+        if max_retries == self.max_retries:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.deadline(max_retries))
+        except asyncio.TimeoutError:
+            raise Exception(f"Timeout while connecting to tracker {addr[0]}:{addr[1]}") from None
+
+    async def _connect(self, addr):
+        for attempt in range(self.max_retries + 1):
+            packet, trans_id = build_connect_request()
+            sent_at = time.monotonic()
+            try:
+                response = await self.send(addr, packet, trans_id, self.timeout(attempt))
+            except asyncio.TimeoutError:
+                continue
+            _, _, con_id = parse_connect_response(response, trans_id)
+            self.connection_ids[addr] = (con_id, sent_at + CONNECTION_ID_LIFETIME)
+            return con_id
+        raise Exception(f"Timeout while waiting on tracker {addr[0]}:{addr[1]}")
+
+    async def request(self, host, port, build_packet, max_retries=None):
+        """
+        Sends a request that needs a connection ID, with BEP 15 retransmission.
+
+        Parameters:
+            build_packet (callable): build_packet(con_id) -> (packet, trans_id)
+            max_retries (int): retransmissions of the connect and of the request,
+                None = the client's max_retries
+
+        Returns:
+            tuple: (response: bytes, trans_id: int)
+        """
+        addr = await self.resolve(host, port)
+        for attempt in range(self.retries(max_retries) + 1):
+            con_id = await self.connection_id(addr, max_retries)
+            packet, trans_id = build_packet(con_id)
+            try:
+                response = await self.send(addr, packet, trans_id, self.timeout(attempt))
+            except asyncio.TimeoutError:
+                continue
+            return response, trans_id
+        raise Exception(f"Timeout while waiting on tracker {host}:{port}")
+
+    async def announce(self, host, port, info_hash, peer_id, downloaded, left, uploaded,
+                       event=EVENT_STARTED, listen_port=DEFAULT_PORT, num_want=DEFAULT_NUM_WANT, max_retries=None):
+        """
+        Parameters:
+            max_retries (int): see request()
+
+        Returns:
+            dictionary: see parse_announce_response
+        """
+        def build_packet(con_id):
+            return build_announce_request(con_id, info_hash, peer_id, downloaded, left, uploaded,
+                                          event, listen_port, num_want)
+
+        response, trans_id = await self.request(host, port, build_packet, max_retries)
+        return parse_announce_response(response, trans_id)
+
+    async def scrape(self, host, port, info_hashes, max_retries=None):
+        """
+        Scrapes any number of torrents, MAX_SCRAPE_HASHES per packet, all packets in parallel.
+
+        Parameters:
+            max_retries (int): see request()
+
+        Returns:
+            dictionary: info_hash -> {seeders, completed, leechers}
+        """
+        async def scrape_batch(batch):
+            response, trans_id = await self.request(host, port, lambda con_id: build_scrape_request(con_id, batch),
+                                                    max_retries)
+            return parse_scrape_response(response, trans_id, batch)
+
+        info_hashes = list(info_hashes)
+        batches = [info_hashes[i:i + MAX_SCRAPE_HASHES] for i in range(0, len(info_hashes), MAX_SCRAPE_HASHES)]
+        result = {}
+        for stats in await asyncio.gather(*(scrape_batch(batch) for batch in batches)):
+            result.update(stats)
+        return result
+
+
 def main():
     "Teste UDP Tracker"
     torrent = torrent_file.parse_torrent_file("linuxmint-22.2-cinnamon-64bit.iso.torrent")
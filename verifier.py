@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import RateMeter
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class PieceVerifier:
+    """
+    Checks SHA1 hashes of pieces on a thread pool.
+
+    hashlib releases the GIL while hashing, so several pieces are verified in
+    parallel and the download loop keeps receiving meanwhile.
+
+    Parameters:
+        workers (int): number of hashing threads
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify")
+        self.lock = threading.Lock()
+        self.meter = RateMeter()
+        self.pieces_ok = 0
+        self.pieces_failed = 0
+
+    def submit(self, piece_index, piece_data, expected_hash, callback=None):
+        """
+        Queues a piece for verification.
+
+        Parameters:
+            callback (callable): callback(piece_index, piece_data, ok), called in a worker thread
+
+        Returns:
+            concurrent.futures.Future: resolves to True if the hash matches
+        """
+        return self.pool.submit(self._verify, piece_index, piece_data, expected_hash, callback)
+
+    def _verify(self, piece_index, piece_data, expected_hash, callback):
+        ok = hashlib.sha1(piece_data).digest() == expected_hash
+        with self.lock:
+            self.meter.add(len(piece_data))
+            if ok:
+                self.pieces_ok += 1
+            else:
+                self.pieces_failed += 1
+        if callback is not None:
+            callback(piece_index, piece_data, ok)
+        return ok
+
+    def feed(self, piece):
+        """
+        Hashes the newly contiguous part of an IncrementalPiece on the pool.
+        At most one job per piece runs at a time, it takes whatever arrived
+        meanwhile, so the blocks are digested in order.
+        """
+        with piece.lock:
+            if piece.digesting:
+                return
+            piece.digesting = True
+        self.pool.submit(self._digest, piece)
+
+    def _digest(self, piece):
+        view = memoryview(piece.data)
+        while True:
+            with piece.lock:
+                start, end = piece.digested, piece.hashed
+                if start == end:
+                    piece.digesting = False
+                    callbacks = piece.take_callbacks() if end == piece.length else []
+                    break
+            piece.sha1.update(view[start:end])
+            with self.lock:
+                self.meter.add(end - start)
+            with piece.lock:
+                piece.digested = end
+        for callback in callbacks:
+            callback(piece)
+
+    def hash_rate(self):
+        """
+        Returns:
+            float: bytes hashed per second
+        """
+        with self.lock:
+            return self.meter.rate()
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+class IncrementalPiece:
+    """
+    Piece buffer that hashes while the blocks arrive.
+
+    Every block that extends the contiguous prefix is fed into a running SHA1
+    right away. Blocks behind a gap only wait in the buffer until the gap is
+    filled, so the digest is ready as soon as the last block lands and no
+    second pass over the piece is needed. With a PieceVerifier the SHA1 runs
+    on its threads instead of the caller's, see when_digested().
+
+    Parameters:
+        index (int): piece index
+        length (int): piece length
+        expected_hash (bytes): 20-byte SHA1 from the torrent
+        verifier (PieceVerifier): hashing threads, None = hash in add_block
+    """
+
+    def __init__(self, index, length, expected_hash, verifier=None):
+        self.index = index
+        self.length = length
+        self.expected_hash = expected_hash
+        self.data = bytearray(length)
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0         # length of the contiguous prefix received
+        self.digested = 0       # length of the prefix fed into sha1
+        self.waiting = {}       # begin -> length of blocks behind a gap
+        self.received = 0
+        self.verifier = verifier
+        self.lock = threading.Lock()
+        self.digesting = False
+        self.callbacks = []
+
+    def add_block(self, begin, block_data):
+        """
+        Returns:
+            bool: False for duplicate or out-of-range blocks
+        """
+        end = begin + len(block_data)
+        if begin < self.hashed or begin in self.waiting or end > self.length or not block_data:
+            return False
+        self.data[begin:end] = block_data
+        self.received += len(block_data)
+        if begin != self.hashed:
+            self.waiting[begin] = len(block_data)
+            return True
+        hashed = end
+        while hashed in self.waiting:
+            hashed += self.waiting.pop(hashed)
+        if self.verifier is None:
+            self.sha1.update(memoryview(self.data)[self.hashed:hashed])
+            self.hashed = self.digested = hashed
+            return True
+        with self.lock:
+            self.hashed = hashed
+        self.verifier.feed(self)
+        return True
+
+    def take_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        return callbacks
+
+    def when_digested(self, callback):
+        """
+        Calls callback(piece) once every byte went through sha1: right away if
+        that already happened, otherwise from the verifier's thread.
+        """
+        with self.lock:
+            if self.digested != self.length:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def is_complete(self):
+        return self.hashed == self.length
+
+    def is_valid(self):
+        return self.digested == self.length and self.sha1.digest() == self.expected_hash